@@ -2,6 +2,7 @@ from os.path import basename, join
 
 import pkg_resources
 from cx_Freeze import Executable, setup
+
 from gparch import VERSION
 
 """
@@ -49,16 +50,22 @@ build_exe_options = {
         "os",
         "pickle",
         "multiprocessing",
+        "asyncio",
+        "aiohttp",
         "piexif",
         "google.auth.transport.requests",
+        "google_auth_httplib2",
         "google_auth_oauthlib.flow",
         "googleapiclient.discovery",
+        "googleapiclient.errors",
         "httplib2",
+        "requests",
         "PIL",
         "tqdm",
         "pkg_resources",
     ],
-    "include_files": collect_dist_info("google_api_python_client") + ["gparch.py"]
+    "include_files": collect_dist_info("google_api_python_client")
+    + ["gparch.py", "gparch_async.py"],
 }
 
 base = None
@@ -69,5 +76,5 @@ setup(
     description="A tool to maintain an archive/mirror of your Google Photos library for backup purposes.",
     options={"build_exe": build_exe_options},
     executables=[Executable("gparch_cli.py", base=base)],
-    py_modules=[]
+    py_modules=[],
 )
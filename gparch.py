@@ -1,21 +1,28 @@
-import io
+import hashlib
 import json
 import os
 import pickle
+import random
+import re
+import socket
 import sqlite3
-from multiprocessing.pool import ThreadPool
-from time import time
+import threading
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from heapq import heappop, heappush
+from itertools import count
+from time import localtime, perf_counter, time
 
-import piexif
-import piexif.helper
-import requests
-from google.auth.transport.requests import Request
 from sanitize_filename import sanitize
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from PIL import Image
 from tqdm import tqdm
 
+# Heavier dependencies (PIL, piexif, requests, httplib2 and the Google API/auth libraries)
+# are imported where they are first needed, so runs that don't use them start faster
+
 """
 Archiver for Google Photos
 By: Nick Dawson | nick@ndawson.me
@@ -50,6 +57,118 @@ SCOPES = [
 
 # Define constants
 DATABASE_NAME = "database.sqlite3"
+DISCOVERY_URL = "https://photoslibrary.googleapis.com/$discovery/rest?version=v1"
+DISCOVERY_CACHE_NAME = "photoslibrary_discovery.json"
+DISCOVERY_CACHE_VERSION = 1  # bump to invalidate every cached discovery document
+DISCOVERY_CACHE_MAX_AGE = 7 * 24 * 60 * 60  # seconds
+DEFAULT_CONNECT_TIMEOUT = 10  # seconds
+DEFAULT_READ_TIMEOUT = 60  # seconds
+DEFAULT_API_CONCURRENCY = 1  # albums listed in parallel
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes held in memory per download thread
+BASE_URL_LIFETIME = 60 * 60  # seconds a listed baseUrl stays valid
+BASE_URL_REFRESH_MARGIN = 10 * 60  # seconds before expiry a baseUrl gets renewed
+BATCH_GET_SIZE = 50  # max ids per mediaItems.batchGet call
+RETRY_ATTEMPTS = 5  # attempts per download or API request before giving up
+RETRY_BASE_DELAY = 1  # seconds, doubled after every failed attempt
+RETRY_MAX_DELAY = 60  # seconds
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+THROTTLE_STATUS_CODES = (429, 503)
+METRICS_PREFIX = "gparch_"
+DEFAULT_METRICS_INTERVAL = 15
+# Histogram bucket upper bounds in seconds
+DOWNLOAD_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+API_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+EXIF_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+METRICS_HELP = {
+    "bytes_downloaded_total": "Media bytes received from the media server",
+    "api_requests_total": "Photos Library API requests made, including retries",
+    "rate_limited_seconds_total": "Time threads waited on the bandwidth and API rate limits",
+    "items_total": "Media items handled by the download scheduler by phase and result",
+    "retries_total": "Requests that were retried after a transient failure",
+    "throttled_total": "Requests the server throttled (429/503)",
+    "resumed_total": "Downloads resumed from a partial file with a Range request",
+    "deduplicated_total": "Downloaded files linked to an identical file",
+    "deduplicated_bytes_total": "Bytes saved by linking identical files",
+    "download_seconds": "Time to download and save one media item",
+    "api_page_seconds": "Time to fetch one page (or batch) from the Photos Library API",
+    "exif_seconds": "Time to write a description into one file's EXIF data",
+    "filesystem_seconds_total": "Time spent syncing, renaming and checking files",
+    "sqlite_seconds_total": "Time spent executing and committing database writes",
+    "connections_opened_total": "Connections opened to the media server",
+    "connections_reused_total": "Media requests that reused a pooled connection",
+    "elapsed_seconds": "Seconds since the session started",
+}
+QUEUE_DEPTH = 4  # entries queued per download thread before listing waits
+VIDEO_QUEUE_SIZE = 2000  # most videos queued, so listing can run past a burst of them
+PRIORITIES = ("listing", "smallest", "oldest", "newest")  # order downloads start in
+DEFAULT_PRIORITY = "listing"
+RESUME_MIN_SIZE = 8 * 1024 * 1024  # bytes, smaller downloads restart from scratch
+LINK_MODES = ("hardlink", "reflink", "off")  # how identical files are stored once
+DEFAULT_LINK_MODE = "hardlink"
+ENGINES = ("thread", "async")  # download engines, async needs aiohttp (gparch_async.py)
+DEFAULT_ENGINE = "thread"
+FICLONE = 0x40049409  # Linux ioctl that makes a copy-on-write clone (reflink) of a file
+DB_BATCH_SIZE = 500  # rows written per database transaction
+DB_COMMIT_INTERVAL = 5  # max seconds a pending write waits to be committed
+# Incremental library sync
+# - the date filter matches the creation date of media, not the upload date, so items
+#   uploaded late (old scans, phones that synced days later) are only caught by the
+#   overlap window or by a periodic full sync
+DEFAULT_OVERLAP_DAYS = 7
+DEFAULT_FULL_SYNC_DAYS = 0  # days between full library syncs, 0 = never
+RATE_BURST_SECONDS = 1  # seconds of traffic let through at once after idling
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+PLAN_VERSION = 1  # bumped when the plan file format changes
+PLAN_SAMPLE_SIZE = 25  # media items per type whose size is checked to estimate the rest
+QUARANTINE_NAME = ".quarantine"  # where verify moves corrupt files until redownloaded
+LIBRARY_LAYOUTS = ("flat", "date", "hash")  # how Library/ is split into directories
+DEFAULT_LIBRARY_LAYOUT = "flat"
+DUPLICATE_SUFFIX = re.compile(r"^(.*) \((\d+)\)$")  # the (#) NameIndex appends
+
+# Database schema migrations
+# - each entry upgrades the schema by one version and they are applied in order
+#   on top of the database's PRAGMA user_version, so existing files upgrade in place
+MIGRATIONS = [
+    # 1 - Original tables
+    """
+    CREATE TABLE IF NOT EXISTS media (uuid text, path text, album_uuid text);
+    CREATE TABLE IF NOT EXISTS albums (uuid text, path text, title text, is_shared integer);
+    """,
+    # 2 - Unique uuid indexes, dropping duplicate rows older versions could insert
+    #     when a missing file was downloaded again (the newest row is kept)
+    """
+    DELETE FROM media WHERE rowid NOT IN (SELECT MAX(rowid) FROM media GROUP BY uuid);
+    DELETE FROM albums WHERE rowid NOT IN (SELECT MAX(rowid) FROM albums GROUP BY uuid);
+    CREATE UNIQUE INDEX IF NOT EXISTS media_uuid ON media (uuid);
+    CREATE UNIQUE INDEX IF NOT EXISTS albums_uuid ON albums (uuid);
+    """,
+    # 3 - In-progress downloads that can be resumed with a Range request
+    """
+    CREATE TABLE IF NOT EXISTS partials (uuid text PRIMARY KEY, part_path text, expected_size integer);
+    """,
+    # 4 - Content hash of every downloaded file, used to store identical files only once
+    """
+    ALTER TABLE media ADD COLUMN sha256 text;
+    CREATE INDEX IF NOT EXISTS media_sha256 ON media (sha256);
+    """,
+    # 5 - Watermarks of the last successful library syncs (unix timestamps)
+    """
+    CREATE TABLE IF NOT EXISTS sync_state (name text PRIMARY KEY, value real);
+    """,
+    # 6 - Size and modification time of every file when it was last known to be intact,
+    #     and media that verify found missing or corrupt, to be downloaded again
+    """
+    ALTER TABLE media ADD COLUMN size integer;
+    ALTER TABLE media ADD COLUMN mtime real;
+    CREATE TABLE IF NOT EXISTS redownloads (uuid text PRIMARY KEY, reason text);
+    """,
+    # 7 - Creation time of every media item (unix timestamp), used by the date layout,
+    #     and archive wide settings such as the Library layout
+    """
+    ALTER TABLE media ADD COLUMN created real;
+    CREATE TABLE IF NOT EXISTS settings (name text PRIMARY KEY, value text);
+    """,
+]
 
 
 def safe_mkdir(path):
@@ -60,23 +179,6 @@ def safe_mkdir(path):
         os.mkdir(path)
 
 
-def auto_mkdir(path, instance=0):
-    """
-    Recursively creates directory and appends a number -> (#) to the end
-    if that directory already exists
-    """
-    if instance:
-        new_path = path + " (" + str(instance) + ")"
-    else:
-        new_path = path
-
-    if not os.path.exists(new_path):
-        os.mkdir(new_path)
-        return os.path.abspath(new_path)
-    else:
-        return auto_mkdir(path, instance + 1)
-
-
 def auto_filename(path, instance=0):
     """
     Recursively finds an available name for a new file and
@@ -96,6 +198,299 @@ def auto_filename(path, instance=0):
         return auto_filename(path, instance + 1)
 
 
+def migrate_database(con):
+    """
+    Applies every migration the database hasn't seen yet, each one in its own transaction
+    """
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        con.executescript(f"BEGIN; {migration} PRAGMA user_version = {number}; COMMIT;")
+
+
+def parse_retry_after(value):
+    """
+    Returns the seconds to wait from a Retry-After header (delay-seconds or HTTP-date), or None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_content_range(value):
+    """
+    Returns (first byte, total size) from a "bytes first-last/total" Content-Range header, or None
+    """
+    try:
+        unit, byte_range = value.split(" ", 1)
+        first, total = byte_range.split("-", 1)[0], byte_range.split("/", 1)[1]
+        if unit != "bytes" or total == "*":
+            return None
+        return int(first), int(total)
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def parse_size(value):
+    """
+    Returns the bytes in a size like "500K", "2.5M" or "1G" (binary units, optional B suffix)
+    """
+    value = value.strip().upper().rstrip("B")
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ""
+    return float(value[: len(value) - len(unit)]) * SIZE_UNITS[unit]
+
+
+def parse_rate_schedule(spec, parse_value=float):
+    """
+    Parses a comma separated rate schedule like "08:00-18:00=2M,20M" into a RateSchedule
+    - HH:MM-HH:MM=RATE applies during that local time of day (it may wrap past midnight)
+    - a rate without a time window is used the rest of the time
+    - "unlimited" turns the limit off, e.g. "09:00-17:00=1M,unlimited"
+    - raises ValueError for a malformed schedule
+    """
+
+    def parse_rate(value):
+        if value.strip().lower() == "unlimited":
+            return None
+        rate = parse_value(value)
+        if rate <= 0:
+            raise ValueError(f"rate must be positive: {value}")
+        return rate
+
+    def parse_minutes(value):
+        hours, minutes = value.split(":")
+        if not (0 <= int(hours) <= 24 and 0 <= int(minutes) < 60):
+            raise ValueError(f"invalid time of day: {value}")
+        return int(hours) * 60 + int(minutes)
+
+    default = None
+    windows = []
+    for part in spec.split(","):
+        if "=" in part:
+            window, rate = part.split("=", 1)
+            start, end = window.split("-", 1)
+            windows.append((parse_minutes(start), parse_minutes(end), parse_rate(rate)))
+        else:
+            default = parse_rate(part)
+    return RateSchedule(default, windows)
+
+
+def parse_bandwidth_schedule(spec):
+    return parse_rate_schedule(spec, parse_size)
+
+
+def parse_qps_schedule(spec):
+    return parse_rate_schedule(spec, float)
+
+
+def hash_file(path, initial=None, size=None):
+    """
+    Returns the sha256 hash object of the file at path, read in DOWNLOAD_CHUNK_SIZE chunks
+    - initial continues an existing hash object, size limits how many bytes are read
+    """
+    sha256 = initial or hashlib.sha256()
+    remaining = os.path.getsize(path) if size is None else size
+    with open(path, "rb") as file:
+        while remaining > 0:
+            chunk = file.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            sha256.update(chunk)
+            remaining -= len(chunk)
+    return sha256
+
+
+def reflink(source, destination):
+    """
+    Creates destination as a copy-on-write clone of source (Linux filesystems like Btrfs/XFS only)
+    """
+    import fcntl
+
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+
+def link_file(source, path, mode=DEFAULT_LINK_MODE):
+    """
+    Replaces the file at path with a link to source (which must have identical content)
+    - reflink mode falls back to a hardlink when the filesystem can't clone files
+    - returns False and leaves path untouched if no link could be made
+    """
+    if mode == "off" or os.path.samefile(source, path):
+        return False
+    link_path = path + ".link"
+    try:
+        if mode == "reflink":
+            try:
+                reflink(source, link_path)
+            except (ImportError, OSError):
+                if os.path.exists(link_path):
+                    os.remove(link_path)
+                os.link(source, link_path)
+        else:
+            os.link(source, link_path)
+        os.replace(link_path, path)
+        return True
+    except OSError:
+        # e.g. the files are on different filesystems or links are unsupported
+        if os.path.exists(link_path):
+            os.remove(link_path)
+        return False
+
+
+def hash_file_hex(path):
+    """
+    Returns the sha256 hex digest of the file at path, or None if it can't be read
+    - a top level function so it can run in a process pool
+    """
+    try:
+        return hash_file(path).hexdigest()
+    except OSError:
+        return None
+
+
+def scan_files(directory, recursive=True, files=None):
+    """
+    Returns {path: os.stat_result} of the files in directory (and below it when recursive),
+    walked with os.scandir
+    - paths are directory + "/" + name, built the same way as the paths of downloads
+    - hidden files and directories (in-progress .part downloads, the quarantine) are skipped
+    """
+    files = {} if files is None else files
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                path = directory + "/" + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        scan_files(path, True, files)
+                elif entry.is_file():
+                    files[path] = entry.stat()
+    except FileNotFoundError:
+        pass
+    return files
+
+
+def get_base_name(name, is_directory=False):
+    """
+    Returns (name without the (#) NameIndex appended to it, #), # is 0 if there is none
+    """
+    stem, extension = (name, "") if is_directory else os.path.splitext(name)
+    match = DUPLICATE_SUFFIX.match(stem)
+    if match is None:
+        return name, 0
+    return match.group(1) + extension, int(match.group(2))
+
+
+def get_library_shard(layout, uuid, created):
+    """
+    Returns the directory below Library/ a media item is stored in with layout ("" when flat)
+    - date: YYYY/MM of the creation time (UTC), or Undated if it isn't known
+    - hash: the first 2 hex digits of the sha1 of the uuid, 256 directories of even size
+    """
+    if layout == "date":
+        if created is None:
+            return "Undated"
+        return datetime.fromtimestamp(created, timezone.utc).strftime("%Y/%m")
+    if layout == "hash":
+        return hashlib.sha1(uuid.encode()).hexdigest()[:2]
+    return ""
+
+
+def remove_empty_dirs(directory):
+    """
+    Removes every empty directory below directory (but not directory itself)
+    """
+    for path, _, _ in os.walk(directory, topdown=False):
+        if path != directory:
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass  # not empty
+
+
+def parse_creation_time(value):
+    """
+    Returns the timestamp of a mediaMetadata creationTime like 2021-06-01T12:00:00.123Z
+    """
+    return datetime.fromisoformat(value[:19]).replace(tzinfo=timezone.utc).timestamp()
+
+
+def get_part_path(path, uuid):
+    """
+    Returns the path of the temporary file a media item is streamed into before it is
+    moved to its final path, named after the item's uuid so items with the same filename
+    never share a temporary file
+    """
+    return os.path.join(os.path.dirname(path), "." + uuid + ".part")
+
+
+def set_exif_description(exif_dict, description):
+    """
+    Stores description as the UserComment of a piexif exif_dict and returns the dumped EXIF bytes
+    """
+    import piexif
+    import piexif.helper
+
+    exif_dict["Exif"][piexif.ExifIFD.UserComment] = piexif.helper.UserComment.dump(
+        description, encoding="unicode"
+    )
+
+    # This is a known bug with piexif (https://github.com/hMatoba/Piexif/issues/95)
+    if 41729 in exif_dict["Exif"]:
+        exif_dict["Exif"][41729] = bytes(exif_dict["Exif"][41729])
+
+    return piexif.dump(exif_dict)
+
+
+def write_description_lossless(path, description):
+    """
+    Splices an updated EXIF segment into the file at path without decoding the image
+    - the compressed image data is copied through byte for byte, so there is no quality loss
+    - raises piexif.InvalidImageDataError for anything that isn't a JPEG or WebP
+    """
+    import piexif
+
+    exif_dict = piexif.load(path)
+    piexif.insert(set_exif_description(exif_dict, description), path)
+
+
+def write_description_reencode(path, description):
+    """
+    Decodes the image at path with Pillow and saves it again with the description in its EXIF data
+    - the image is re-saved to a temporary file which then replaces the original
+    """
+    import piexif
+    from PIL import Image, UnidentifiedImageError
+
+    exif_path = path + ".exif"
+    try:
+        with Image.open(path) as img:
+            img.load()
+            if "exif" in img.info:
+                exif_dict = piexif.load(img.info["exif"])
+            else:
+                exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}}
+            exif_bytes = set_exif_description(exif_dict, description)
+            img.save(exif_path, format=img.format, exif=exif_bytes)
+        os.replace(exif_path, path)
+    except (ValueError, UnidentifiedImageError):
+        # This value here is to catch a specific scenario with file extensions that have
+        # descriptions that are unsupported by Pillow so the program can't modify the EXIF data.
+        # Files Pillow can't open at all (e.g. videos with a description) are kept as downloaded.
+        print(" [INFO] media file unsupported, can't write description to EXIF data.")
+        if os.path.exists(exif_path):
+            os.remove(exif_path)
+
+
 def save_json(variable, path):
     json.dump(variable, open(auto_filename(path), "w"))
 
@@ -118,8 +513,1198 @@ def load_database(path, init_dict):
     return db
 
 
+class Histogram(object):
+    """
+    Cumulative histogram with fixed bucket upper bounds (Prometheus style)
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics(object):
+    """
+    Thread-safe counters, gauges and histograms of a session
+    - exported as JSON or as a Prometheus textfile (for node_exporter's textfile collector)
+    - metrics are identified by name plus keyword labels, e.g. increment("items_total", phase="library")
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # {(name, labels): value}
+        self.gauges = {}
+        self.histograms = {}  # {(name, labels): Histogram}
+        self.collectors = []  # callables run before every export, e.g. to set gauges
+        self.write_lock = threading.Lock()  # the final write can race the MetricsWriter
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, counter=False, **labels):
+        """
+        Sets a gauge, or a counter (counter=True) whose total is tracked elsewhere
+        """
+        with self.lock:
+            values = self.counters if counter else self.gauges
+            values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, buckets=None, **labels):
+        """
+        Records how long the with block took, in a histogram if buckets are given
+        or else added to the name counter
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            if buckets is None:
+                self.increment(name, seconds, **labels)
+            else:
+                self.observe(name, seconds, buckets, **labels)
+
+    def get(self, name, **labels):
+        """
+        Returns the sum of a counter over every label set matching labels
+        """
+        with self.lock:
+            return sum(
+                value
+                for (key_name, key_labels), value in self.counters.items()
+                if key_name == name and set(labels.items()) <= set(key_labels)
+            )
+
+    def collect(self):
+        for collector in self.collectors:
+            collector()
+
+    def to_dict(self):
+        self.collect()
+        metrics = {}
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for (name, labels), value in sorted(values.items()):
+                    metrics.setdefault(name, {"type": kind, "values": []})[
+                        "values"
+                    ].append({"labels": dict(labels), "value": value})
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metrics.setdefault(name, {"type": "histogram", "values": []})[
+                    "values"
+                ].append(
+                    {
+                        "labels": dict(labels),
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "buckets": {
+                            str(bound): total for bound, total in histogram.cumulative()
+                        },
+                    }
+                )
+        return {"timestamp": time(), "metrics": metrics}
+
+    def to_prometheus(self):
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = (
+                f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                for key, value in pairs
+            )
+            return "{" + ",".join(escaped) + "}"
+
+        lines = []
+        for name, metric in self.to_dict()["metrics"].items():
+            full_name = METRICS_PREFIX + name
+            if name in METRICS_HELP:
+                lines.append(f"# HELP {full_name} {METRICS_HELP[name]}")
+            lines.append(f"# TYPE {full_name} {metric['type']}")
+            for value in metric["values"]:
+                labels = value["labels"].items()
+                if metric["type"] == "histogram":
+                    for bound, total in value["buckets"].items():
+                        le = "+Inf" if bound == "inf" else bound
+                        lines.append(
+                            f"{full_name}_bucket{format_labels(labels, [('le', le)])} {total}"
+                        )
+                    lines.append(
+                        f"{full_name}_sum{format_labels(labels)} {value['sum']}"
+                    )
+                    lines.append(
+                        f"{full_name}_count{format_labels(labels)} {value['count']}"
+                    )
+                else:
+                    lines.append(f"{full_name}{format_labels(labels)} {value['value']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path=None, prometheus_path=None):
+        """
+        Writes the current metrics to the given files, replacing them atomically
+        """
+        with self.write_lock:
+            for path, content in (
+                (json_path, lambda: json.dumps(self.to_dict(), indent=2)),
+                (prometheus_path, self.to_prometheus),
+            ):
+                if path:
+                    with open(path + ".tmp", "w") as file:
+                        file.write(content())
+                    os.replace(path + ".tmp", path)
+
+
+class MetricsWriter(object):
+    """
+    Background thread writing a Metrics snapshot every interval seconds until stopped
+    """
+
+    def __init__(self, metrics, interval, json_path=None, prometheus_path=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.paths = (json_path, prometheus_path)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="metrics", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.metrics.write(*self.paths)
+            except OSError as e:
+                print(" [ERROR] metrics could not be written because:", e)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class PooledTransport(object):
+    """
+    Shared keep-alive HTTP transport used for every media download
+    - a single requests.Session is shared by all download threads so TCP/TLS
+      connections are reused instead of being re-established for every item
+    - the connection pool is sized to the thread count and blocks when full,
+      so there are never more open connections than there are workers
+    """
+
+    def __init__(
+        self,
+        pool_size,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        read_timeout=DEFAULT_READ_TIMEOUT,
+    ):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.lock = threading.Lock()
+        self.session = None  # created by the first request
+        self.adapter = None
+
+    def get_session(self):
+        with self.lock:
+            if self.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                self.adapter = HTTPAdapter(
+                    pool_connections=4,  # Number of distinct hosts to keep pools for
+                    pool_maxsize=self.pool_size,
+                    pool_block=True,
+                )
+                self.session = requests.Session()
+                self.session.mount("https://", self.adapter)
+                self.session.mount("http://", self.adapter)
+            return self.session
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.get_session().get(url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs.setdefault("allow_redirects", True)
+        return self.get_session().head(url, **kwargs)
+
+    def get_stats(self):
+        """
+        Returns (requests, connections opened, connections reused) summed over
+        every host pool the transport currently holds
+        """
+        num_requests = 0
+        num_connections = 0
+        if self.adapter is None:
+            return 0, 0, 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+        return num_requests, num_connections, num_requests - num_connections
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+
+class DatabaseWriter(object):
+    """
+    Single owner of every write to the database
+    - writes run inside one open transaction that is committed every batch_size rows
+      or commit_interval seconds, instead of committing once per downloaded file
+    - a background thread commits writes that are left pending for commit_interval seconds,
+      e.g. while every thread is busy with a long video download
+    - every read and write goes through the same lock so worker threads can share the connection
+    """
+
+    def __init__(
+        self, con, batch_size=DB_BATCH_SIZE, commit_interval=DB_COMMIT_INTERVAL
+    ):
+        self.con = con
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.lock = threading.RLock()
+        self.pending = 0
+        self.last_commit = time()
+        self.seconds = 0  # time spent executing and committing writes
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="database", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.commit_interval / 2):
+            try:
+                with self.lock:
+                    if time() - self.last_commit >= self.commit_interval:
+                        self.commit()
+            except sqlite3.Error as e:
+                print(" [ERROR] database writes could not be committed because:", e)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.commit()
+
+    def executemany(self, sql, rows):
+        """
+        Bulk loads rows with one statement and commits them in a single transaction
+        """
+        with self.lock:
+            start = perf_counter()
+            self.con.executemany(sql, rows)
+            self.pending += 1
+            self.seconds += perf_counter() - start
+            self.commit()
+
+    def execute(self, sql, parameters=(), commit=False):
+        with self.lock:
+            start = perf_counter()
+            self.con.execute(sql, parameters)
+            self.pending += 1
+            self.seconds += perf_counter() - start
+            if (
+                commit
+                or self.pending >= self.batch_size
+                or time() - self.last_commit >= self.commit_interval
+            ):
+                self.commit()
+
+    def commit(self):
+        with self.lock:
+            start = perf_counter()
+            if self.pending:
+                self.con.commit()
+            self.pending = 0
+            self.last_commit = time()
+            self.seconds += perf_counter() - start
+
+
+class TransientHTTPError(Exception):
+    """
+    Raised for media server responses that are worth retrying (throttling and 5xx errors)
+    """
+
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"media server responded with HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class IncompleteDownloadError(ConnectionError):
+    """
+    Raised when a download doesn't end at the size the media server announced, retried like a
+    dropped connection (tracked partial downloads continue from where it stopped)
+    """
+
+
+class AdaptiveConcurrency(object):
+    """
+    Limits how many operations run at once with AIMD (additive increase, multiplicative decrease)
+    - the limit is halved when the server throttles us, at most once per cooldown
+    - after every `limit` successful operations in a row the limit grows by one, up to max_limit
+    """
+
+    def __init__(self, max_limit, cooldown=5):
+        self.max_limit = max(1, max_limit)
+        self.limit = self.max_limit
+        self.cooldown = cooldown
+        self.condition = threading.Condition()
+        self.active = 0
+        self.successes = 0
+        self.last_decrease = 0
+        self.decreases = 0
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def on_success(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify()
+
+    def on_throttle(self):
+        with self.condition:
+            self.successes = 0
+            if time() - self.last_decrease >= self.cooldown:
+                self.limit = max(1, self.limit // 2)
+                self.last_decrease = time()
+                self.decreases += 1
+
+
+class RateSchedule(object):
+    """
+    Rate limit that depends on the local time of day
+    - windows is a list of (start minute, end minute, rate), the first matching window wins
+    - a rate of None means unlimited
+    """
+
+    def __init__(self, default=None, windows=()):
+        self.default = default
+        self.windows = list(windows)
+
+    def get_rate(self, now=None):
+        now = localtime(now)
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.windows:
+            wraps_midnight = end < start
+            if start <= minute < end or (
+                wraps_midnight and (minute >= start or minute < end)
+            ):
+                return rate
+        return self.default
+
+
+class TokenBucket(object):
+    """
+    Token bucket limiter shared by every thread, e.g. for bytes/s or requests/s
+    - acquire(amount) takes amount tokens, waiting while the bucket is empty
+    - tokens can go negative so amounts bigger than the bucket (a large chunk on a slow
+      limit) are let through and paid back by the callers after it
+    - the rate follows schedule (a RateSchedule or None for unlimited) and waits end
+      early when stop_event is set
+    """
+
+    def __init__(
+        self, schedule=None, stop_event=None, burst_seconds=RATE_BURST_SECONDS
+    ):
+        self.schedule = schedule
+        self.stop_event = stop_event or threading.Event()
+        self.burst_seconds = burst_seconds
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.updated = perf_counter()
+        self.waited = 0.0  # seconds callers spent waiting for tokens
+
+    def reserve(self, amount=1):
+        """
+        Takes amount tokens and returns the seconds the caller must wait before using them
+        """
+        if self.schedule is None:
+            return 0
+        rate = self.schedule.get_rate()
+        with self.lock:
+            now = perf_counter()
+            if rate is None:
+                self.tokens = 0.0
+                self.updated = now
+                return 0
+            capacity = rate * self.burst_seconds
+            self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+            self.waited += wait
+        return wait
+
+    def acquire(self, amount=1):
+        wait = self.reserve(amount)
+        if wait:
+            self.stop_event.wait(wait)
+
+
+class RetryPolicy(object):
+    """
+    Runs operations again after transient failures with jittered exponential backoff
+    - a Retry-After from the server is always honoured
+    - throttling responses are reported to the (optional) AdaptiveConcurrency limiter
+    - backoff sleeps end early when stop_event is set
+    """
+
+    def __init__(
+        self,
+        limiter=None,
+        stop_event=None,
+        on_retry=None,
+        attempts=RETRY_ATTEMPTS,
+        base_delay=RETRY_BASE_DELAY,
+        max_delay=RETRY_MAX_DELAY,
+    ):
+        self.limiter = limiter
+        self.stop_event = stop_event or threading.Event()
+        self.on_retry = on_retry  # called with (retried, throttled) on failures
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.throttled = 0
+
+    @staticmethod
+    def classify(error):
+        """
+        Returns (should retry, was throttled, retry after seconds) for an exception
+        """
+        import httplib2
+        import requests
+        from googleapiclient.errors import HttpError
+
+        if isinstance(error, TransientHTTPError):
+            return True, error.status in THROTTLE_STATUS_CODES, error.retry_after
+        if isinstance(error, HttpError):
+            status = error.resp.status
+            return (
+                status in RETRY_STATUS_CODES,
+                status in THROTTLE_STATUS_CODES,
+                parse_retry_after(error.resp.get("retry-after")),
+            )
+        if isinstance(
+            error,
+            (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                httplib2.HttpLib2Error,
+                ConnectionError,
+                TimeoutError,
+                socket.timeout,
+            ),
+        ):
+            return True, False, None
+        return False, False, None
+
+    def get_delay(self, error, attempt):
+        """
+        Records a failed attempt and returns the seconds to wait before trying again,
+        or None when the error should be raised
+        """
+        retry, throttled, retry_after = self.classify(error)
+        if throttled:
+            with self.lock:
+                self.throttled += 1
+            if self.limiter is not None:
+                self.limiter.on_throttle()
+        if not retry or attempt == self.attempts or self.stop_event.is_set():
+            if self.on_retry is not None:
+                self.on_retry(False, throttled)
+            return None
+        if self.on_retry is not None:
+            self.on_retry(True, throttled)
+
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        )
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        with self.lock:
+            self.retries += 1
+        return delay
+
+    def run(self, operation):
+        for attempt in range(1, self.attempts + 1):
+            try:
+                if self.limiter is None:
+                    result = operation()
+                else:
+                    with self.limiter:
+                        result = operation()
+            except Exception as e:
+                delay = self.get_delay(e, attempt)
+                if delay is None:
+                    raise
+                self.stop_event.wait(delay)
+            else:
+                if self.limiter is not None:
+                    self.limiter.on_success()
+                return result
+
+
+class NameIndex(object):
+    """
+    Hands out free file and directory names (appending a number -> (#) like auto_filename)
+    without probing the filesystem one suffix at a time
+    - each directory is listed once with os.scandir, every later lookup is in memory
+    - names are reserved under a lock, so two threads are never given the same name
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.directories = {}  # {directory: set of names in the directory}
+        self.next_instance = {}  # {(directory, name): next (#) worth trying}
+
+    def get_names(self, directory):
+        # Caller must hold self.lock
+        key = os.path.normcase(os.path.abspath(directory))
+        names = self.directories.get(key)
+        if names is None:
+            names = set()
+            if os.path.isdir(directory):
+                with os.scandir(directory) as entries:
+                    names = {os.path.normcase(entry.name) for entry in entries}
+            self.directories[key] = names
+        return names
+
+    def reserve(self, path, is_directory=False):
+        """
+        Returns path, or path with the lowest free (#) appended, and marks the name as taken
+        """
+        directory, name = os.path.split(path)
+        stem, extension = (name, "") if is_directory else os.path.splitext(name)
+
+        with self.lock:
+            names = self.get_names(directory)
+            key = (os.path.normcase(os.path.abspath(directory)), os.path.normcase(name))
+            instance = self.next_instance.get(key, 0)
+            while True:
+                candidate = name if not instance else f"{stem} ({instance}){extension}"
+                if os.path.normcase(candidate) not in names:
+                    break
+                instance += 1
+            names.add(os.path.normcase(candidate))
+            self.next_instance[key] = instance + 1
+
+        return directory + "/" + candidate if directory else candidate
+
+    def release(self, path):
+        """
+        Frees a reserved name that ended up not being used
+        """
+        directory, name = os.path.split(path)
+        with self.lock:
+            self.get_names(directory).discard(os.path.normcase(name))
+            self.next_instance.pop(
+                (os.path.normcase(os.path.abspath(directory)), os.path.normcase(name)),
+                None,
+            )
+
+
+class MediaEntry(object):
+    """
+    Compact download entry holding only what the downloader needs from a listed media item
+    - the API dict (mediaMetadata, contributor info...) is dropped as soon as the entry is made
+    - __slots__ leaves out the per object dict, and path is kept as a directory string shared
+      by every entry of a phase plus a filename
+    - see the README's Benchmarks section for what 100k entries take (gparch_bench.py memory)
+    """
+
+    __slots__ = (
+        "uuid",
+        "album_uuid",
+        "base_url",
+        "is_video",
+        "directory",
+        "filename",
+        "description",
+        "listed_at",
+        "created",
+        "pixels",
+    )
+
+    def __init__(
+        self,
+        uuid,
+        base_url,
+        is_video,
+        filename,
+        description=None,
+        listed_at=None,
+        album_uuid=None,
+        directory=None,
+        created=None,
+        pixels=None,
+    ):
+        self.uuid = uuid
+        self.album_uuid = album_uuid
+        self.base_url = base_url
+        self.is_video = is_video
+        self.directory = directory  # None when filename is the whole path
+        self.filename = filename
+        self.description = description
+        self.listed_at = listed_at
+        self.created = created  # creationTime timestamp (priority, date layout)
+        self.pixels = pixels  # width * height, how large the media is likely to be
+
+    @classmethod
+    def from_media_item(cls, item, listed_at=None):
+        """
+        Returns the entry of a media item dict from the API, or None if it isn't an image or video
+        """
+        mime_type = item.get("mimeType", "")
+        if "image" in mime_type:
+            is_video = False
+        elif "video" in mime_type:
+            is_video = True
+        else:
+            return None
+        metadata = item.get("mediaMetadata", {})
+        try:
+            pixels = int(metadata["width"]) * int(metadata["height"])
+        except (KeyError, ValueError):
+            pixels = None
+        try:
+            created = parse_creation_time(metadata["creationTime"])
+        except (KeyError, ValueError):
+            created = None
+        return cls(
+            item["id"],
+            item["baseUrl"],
+            is_video,
+            item["filename"],
+            item.get("description"),
+            listed_at or time(),
+            created=created,
+            pixels=pixels,
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Returns the entry of a [uuid, album uuid, url, path, description, listed at,
+        created, pixels] row (plan files), created and pixels may be missing
+        """
+        uuid, album_uuid, url, path, description, listed_at = row[:6]
+        created, pixels = row[6:8] if len(row) >= 8 else (None, None)
+        base_url, suffix = url.rsplit("=", 1)
+        return cls(
+            uuid,
+            base_url,
+            suffix == "dv",
+            path,
+            description,
+            listed_at,
+            album_uuid,
+            created=created,
+            pixels=pixels,
+        )
+
+    def to_row(self):
+        return [
+            self.uuid,
+            self.album_uuid,
+            self.url,
+            self.path,
+            self.description,
+            self.listed_at,
+            self.created,
+            self.pixels,
+        ]
+
+    @property
+    def url(self):
+        return self.base_url + ("=dv" if self.is_video else "=d")
+
+    @property
+    def path(self):
+        if self.directory is None:
+            return self.filename
+        return self.directory + "/" + self.filename
+
+
+def iter_entries(media_items):
+    """
+    Generator turning listed media item dicts into MediaEntry objects one at a time
+    - entries listed within the same second share one listed_at float
+    """
+    listed_at = 0
+    for item in media_items:
+        now = time()
+        if now - listed_at >= 1:
+            listed_at = now
+        entry = MediaEntry.from_media_item(item, listed_at)
+        if entry is not None:
+            yield entry
+
+
+class DownloadPhase(object):
+    """
+    Progress of one phase (favorites, an album, the library...) submitted to a DownloadScheduler
+    """
+
+    def __init__(self, desc, kind):
+        self.desc = desc
+        self.kind = kind  # favorites, album, shared_album, library or repair
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.listing = True
+        self.submitted = 0
+        self.completed = 0
+        self.downloaded = 0
+        self.failed = 0
+        self.bytes = 0
+        self.started = time()
+        self.seconds = 0
+        self.progress_bar = tqdm(unit=" media items", desc=desc)
+
+    def add(self):
+        with self.lock:
+            self.submitted += 1
+
+    def add_bytes(self, amount):
+        with self.lock:
+            self.bytes += amount
+
+    def complete(self, downloaded=False, failed=False):
+        with self.lock:
+            self.completed += 1
+            self.downloaded += downloaded
+            self.failed += failed
+            self.progress_bar.set_postfix_str(self.get_bytes_progress(), refresh=False)
+            self.progress_bar.update()
+            self.check_done()
+
+    def get_bytes_progress(self):
+        # Caller must hold self.lock
+        seconds = max(time() - self.started, 1e-9)
+        return (
+            tqdm.format_sizeof(self.bytes, "B", 1024)
+            + ", "
+            + tqdm.format_sizeof(self.bytes / seconds, "B/s", 1024)
+        )
+
+    def finish_listing(self):
+        with self.lock:
+            self.listing = False
+            self.check_done()
+
+    def check_done(self):
+        # Caller must hold self.lock
+        if (
+            not self.listing
+            and self.completed == self.submitted
+            and not self.done.is_set()
+        ):
+            self.seconds = time() - self.started
+            self.progress_bar.close()
+            if self.downloaded or self.failed:
+                print(
+                    f"{self.desc}: {self.downloaded} downloaded "
+                    f"({tqdm.format_sizeof(self.bytes, 'B', 1024)}), "
+                    f"{self.completed - self.downloaded - self.failed} already downloaded, "
+                    f"{self.failed} failed ({self.seconds:.1f}s)"
+                )
+            else:
+                print(f"{self.desc}: Everything already downloaded.")
+            self.done.set()
+
+
+class SyncPlan(object):
+    """
+    What a sync would download, built by listing everything without downloading anything
+    - each phase keeps the entries that would be downloaded, in download order, so
+      the plan can be saved and replayed by a later run without listing again
+    - entry sizes are None until estimated (only a sample is checked, see PhotosAccount.estimate_plan)
+    """
+
+    def __init__(self, directory, phases=None, created=None):
+        self.directory = directory
+        self.phases = phases or []
+        self.created = created or time()
+
+    def add_phase(self, desc, kind, album=None):
+        """
+        album is {"id", "path", "title", "shared", "new"} for album phases, new albums
+        don't have a directory yet
+        """
+        phase = {
+            "desc": desc,
+            "kind": kind,
+            "album": album,
+            "listed": 0,
+            "entries": [],
+            "sizes": [],
+        }
+        self.phases.append(phase)
+        return phase
+
+    def get_summary(self):
+        """
+        Returns [(kind, listed, already downloaded, to download, estimated bytes)] with one
+        row per phase kind in the order they ran, estimated bytes is None if unknown
+        """
+        summary = {}
+        for phase in self.phases:
+            listed, existing, planned, size = summary.get(phase["kind"], (0, 0, 0, 0))
+            phase_size = None if None in phase["sizes"] else sum(phase["sizes"])
+            summary[phase["kind"]] = (
+                listed + phase["listed"],
+                existing + phase["listed"] - len(phase["entries"]),
+                planned + len(phase["entries"]),
+                None if size is None or phase_size is None else size + phase_size,
+            )
+        return [(kind,) + row for kind, row in summary.items()]
+
+    def save(self, path):
+        with open(path + ".tmp", "w") as file:
+            json.dump(
+                {
+                    "version": PLAN_VERSION,
+                    "created": self.created,
+                    "directory": self.directory,
+                    "phases": [
+                        dict(
+                            phase,
+                            entries=[entry.to_row() for entry in phase["entries"]],
+                        )
+                        for phase in self.phases
+                    ],
+                },
+                file,
+            )
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            plan = json.load(file)
+        if plan.get("version") != PLAN_VERSION:
+            raise ValueError(f"unsupported plan file version: {plan.get('version')}")
+        for phase in plan["phases"]:
+            phase["entries"] = [MediaEntry.from_row(row) for row in phase["entries"]]
+        return cls(plan["directory"], plan["phases"], plan["created"])
+
+
+class DownloadLanes(object):
+    """
+    Queued entries of a download scheduler, split into an image lane and a video lane
+    - each lane has its own concurrency limit, so a burst of large videos can't take every
+      download while thousands of small images wait behind them
+    - queued entries start in priority order (see PRIORITIES), entries with equal priority
+      (every entry with "listing") start in the order they were submitted
+    - with "smallest" pixel counts only order entries within a lane, queued images start
+      before queued videos whenever both lanes have room
+    - the image lane queues QUEUE_DEPTH entries per download, the video lane up to
+      VIDEO_QUEUE_SIZE, so listing can run past a burst of videos to the images behind it
+    - not thread safe, push, pop and release must be called with the scheduler's lock held
+    """
+
+    def __init__(self, limit, image_limit, video_limit, priority=DEFAULT_PRIORITY):
+        self.limit = limit
+        self.limits = {
+            "image": min(image_limit, limit),
+            "video": min(video_limit, limit),
+        }
+        self.priority = priority
+        self.slots = {
+            "image": threading.BoundedSemaphore(limit * QUEUE_DEPTH),
+            "video": threading.BoundedSemaphore(VIDEO_QUEUE_SIZE),
+        }
+        self.queues = {"image": [], "video": []}
+        self.active = {"image": 0, "video": 0}
+        self.completed = {"image": 0, "video": 0}
+        self.finished_at = {"image": None, "video": None}
+        self.order = count()
+
+    @staticmethod
+    def get_lane(entry):
+        return "video" if entry.is_video else "image"
+
+    def get_priority(self, entry):
+        # Entries without the metadata a policy needs start after the others
+        if self.priority == "listing":
+            return 0
+        if self.priority == "smallest":
+            # Pixel counts of images and videos aren't comparable (a 1080p video has fewer
+            # than a 12 MP photo), so between lanes images start first
+            return (entry.is_video, entry.pixels or float("inf"))
+        if self.priority in ("oldest", "newest") and entry.created is not None:
+            return entry.created if self.priority == "oldest" else -entry.created
+        return float("inf")
+
+    def reserve(self, entry):
+        """
+        Waits until the entry's lane has room to queue it, and returns the lane
+        """
+        lane = self.get_lane(entry)
+        self.slots[lane].acquire()
+        return lane
+
+    def push(self, phase, entry):
+        heappush(
+            self.queues[self.get_lane(entry)],
+            (self.get_priority(entry), next(self.order), phase, entry),
+        )
+
+    def pop(self):
+        """
+        Returns (lane, phase, entry) of the queued entry that should start next, or None
+        if nothing is queued in a lane that is below its limit
+        """
+        if sum(self.active.values()) >= self.limit:
+            return None
+        ready = [
+            lane
+            for lane, queue in self.queues.items()
+            if queue and self.active[lane] < self.limits[lane]
+        ]
+        if not ready:
+            return None
+        lane = min(ready, key=lambda lane: self.queues[lane][0][:2])
+        _, _, phase, entry = heappop(self.queues[lane])
+        self.active[lane] += 1
+        return lane, phase, entry
+
+    def release(self, lane):
+        # Called once the entry pop returned has finished
+        self.active[lane] -= 1
+        self.completed[lane] += 1
+        self.finished_at[lane] = time()
+        self.slots[lane].release()
+
+
+class DownloadScheduler(object):
+    """
+    One long-lived pool of download threads shared by every phase of a session
+    - phases submit entries as they are listed and don't wait for each other to finish,
+      so a small album never leaves most of the threads idle
+    - entries wait in DownloadLanes, which decides which one starts next, so with the
+      default "listing" priority phases keep their order
+    - queues are bounded (see DownloadLanes), so listing can't run arbitrarily far
+      ahead of downloading
+    """
+
+    def __init__(self, worker, thread_count, on_result, metrics, lanes):
+        self.worker = worker
+        self.on_result = on_result
+        self.metrics = metrics
+        self.lanes = lanes
+        self.ready = threading.Condition()  # guards lanes, notified on changes
+        self.local = threading.local()  # phase of the entry each thread is working on
+        self.executor = ThreadPoolExecutor(
+            max_workers=thread_count, thread_name_prefix="download"
+        )
+        self.stopping = threading.Event()
+        self.phases = []
+
+    def start_phase(self, desc, kind):
+        phase = DownloadPhase(desc, kind)
+        self.phases.append(phase)
+        return phase
+
+    def submit(self, phase, entry):
+        lane = self.lanes.reserve(entry)
+        phase.add()
+        with self.ready:
+            self.lanes.push(phase, entry)
+            # A thread may be waiting on a full lane while this entry's lane has room
+            self.ready.notify()
+        try:
+            self.executor.submit(self.run_next)
+        except BaseException:
+            self.lanes.slots[lane].release()
+            phase.complete(failed=True)
+            raise
+
+    def run_next(self):
+        """
+        Runs whichever queued entry should start next, every submitted entry queues one call
+        - waits while every lane that has queued entries is at its limit
+        """
+        with self.ready:
+            item = self.ready.wait_for(
+                lambda: self.stopping.is_set() or self.lanes.pop()
+            )
+        if item is True:
+            return  # stopping, like the entries cancelled with the executor
+        lane, phase, entry = item
+        try:
+            self.run(phase, entry)
+        finally:
+            with self.ready:
+                self.lanes.release(lane)
+                self.ready.notify()
+
+    def run(self, phase, entry):
+        result = None
+        self.local.phase = phase
+        start = perf_counter()
+        try:
+            if not self.stopping.is_set():
+                result = self.worker(entry)
+                if result:
+                    self.metrics.observe(
+                        "download_seconds",
+                        perf_counter() - start,
+                        DOWNLOAD_BUCKETS,
+                        phase=phase.kind,
+                    )
+                    self.on_result(*result)
+        except Exception as e:
+            print(" [ERROR] media item could not be saved because:", e)
+        finally:
+            self.local.phase = None
+            # download workers return False when the item was already downloaded
+            outcome = (
+                "downloaded" if result else "failed" if result is None else "skipped"
+            )
+            self.metrics.increment("items_total", phase=phase.kind, result=outcome)
+            phase.complete(downloaded=bool(result), failed=result is None)
+
+    def join(self):
+        for phase in self.phases:
+            phase.done.wait()
+
+    def shutdown(self):
+        """
+        Stops the scheduler, cancelling queued entries and interrupting running downloads
+        """
+        self.stopping.set()
+        with self.ready:
+            self.ready.notify_all()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class BaseUrlRefresher(object):
+    """
+    Renews baseUrls that are about to expire (or were rejected) through mediaItems.batchGet
+    - entries waiting in the download queue are registered, so renewing one entry also renews
+      up to BATCH_GET_SIZE - 1 other entries that are close to expiring in the same call
+    - batch_get(uuids) must return a {uuid: baseUrl} dict
+    """
+
+    def __init__(self, batch_get):
+        self.batch_get = batch_get
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()  # only one batchGet runs at a time
+        self.queued = {}  # {uuid: listed_at} of entries waiting to download
+        self.renewed = {}  # {uuid: (baseUrl, renewed_at)}
+        self.refreshes = 0
+
+    @staticmethod
+    def is_stale(listed_at, margin=BASE_URL_REFRESH_MARGIN):
+        return time() - listed_at > BASE_URL_LIFETIME - margin
+
+    def register(self, uuid, listed_at):
+        with self.lock:
+            self.queued[uuid] = listed_at
+
+    def unregister(self, uuid):
+        with self.lock:
+            self.queued.pop(uuid, None)
+
+    def get_url(self, uuid, url, listed_at, force=False):
+        """
+        Returns a usable download url for the entry, renewing its baseUrl if needed
+        - force renews the baseUrl even if it should still be valid (e.g. it was rejected)
+        """
+        suffix = "=dv" if url.endswith("=dv") else "=d"
+
+        with self.lock:
+            renewed = self.renewed.pop(uuid, None)
+        if renewed and not force:
+            base_url, listed_at = renewed
+            url = base_url + suffix
+        if not force and not self.is_stale(listed_at):
+            return url
+
+        with self.refresh_lock:
+            # Renew the baseUrls of this entry and the queued entries closest to expiring
+            with self.lock:
+                stale = sorted(
+                    (
+                        queued_uuid
+                        for queued_uuid, queued_at in self.queued.items()
+                        if queued_uuid != uuid
+                        and queued_uuid not in self.renewed
+                        and self.is_stale(queued_at, 2 * BASE_URL_REFRESH_MARGIN)
+                    ),
+                    key=self.queued.get,
+                )
+            uuids = [uuid] + stale[: BATCH_GET_SIZE - 1]
+            base_urls = self.batch_get(uuids)
+            renewed_at = time()
+            self.refreshes += 1
+            with self.lock:
+                for renewed_uuid, base_url in base_urls.items():
+                    if renewed_uuid != uuid:
+                        self.renewed[renewed_uuid] = (base_url, renewed_at)
+
+        if uuid not in base_urls:
+            raise LookupError("media item's baseUrl could not be renewed")
+        return base_urls[uuid] + suffix
+
+
 class PhotosAccount(object):
-    def __init__(self, credentials_path, directory, thread_count, debug):
+    def __init__(
+        self,
+        credentials_path,
+        directory,
+        thread_count,
+        debug,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        read_timeout=DEFAULT_READ_TIMEOUT,
+        api_concurrency=DEFAULT_API_CONCURRENCY,
+        link_mode=DEFAULT_LINK_MODE,
+        bandwidth_schedule=None,
+        api_qps_schedule=None,
+        engine=DEFAULT_ENGINE,
+        image_threads=None,
+        video_threads=None,
+        priority=DEFAULT_PRIORITY,
+        library_layout=None,
+    ):
         # Define directory instance variables
         self.base_dir = directory
         self.lib_dir = self.base_dir + "/Library"
@@ -131,18 +1716,21 @@ class PhotosAccount(object):
         self.thread_count = thread_count
         self.credentials = credentials_path
         self.service = None  # is None because it will be defined later by calling "get_google_api_service"
+        self.google_credentials = None
+        self.api_concurrency = api_concurrency
+        self.api_local = threading.local()  # per thread http objects for API calls
+        self.link_mode = link_mode
+        self.names = NameIndex()
         self.timer = time()
-        self.downloads = 0
+        self.metrics = Metrics()
+        self.metrics.collectors.append(self.collect_metrics)
+        self.metrics_writer = None
         self.debug = debug
+        self.transport = PooledTransport(thread_count, connect_timeout, read_timeout)
 
         if self.debug:
             safe_mkdir("debug")
 
-        # Define/Init Database
-        self.db_path = self.base_dir + "/" + DATABASE_NAME
-        self.con = self.init_db()
-        self.cur = self.con.cursor()
-
         # Create the directories (if not already there)
         safe_mkdir(self.base_dir)
         safe_mkdir(self.lib_dir)
@@ -150,7 +1738,154 @@ class PhotosAccount(object):
         safe_mkdir(self.shared_albums_dir)
         safe_mkdir(self.favorites_dir)
 
+        # Define/Init Database
+        self.db_path = self.base_dir + "/" + DATABASE_NAME
+        self.con = self.init_db()
+        self.cur = self.con.cursor()
+        self.writer = DatabaseWriter(self.con)
+        self.known_media = self.load_known_media()
+        self.partials = self.load_partials()
+        self.redownloads = self.load_redownloads()
+        self.library_sync = None  # (started at, full sync, phase) until downloaded
+        self.plan = None  # SyncPlan collecting entries instead of downloading (dry run)
+        self.claimed_media = set()  # uuids already handed to a phase this session
+
+        # The Library layout is remembered by the archive, library_layout changes it
+        # for new downloads (migrate_library_layout also moves the existing files)
+        stored_layout = self.select_setting("library_layout")
+        self.library_layout = library_layout or stored_layout or DEFAULT_LIBRARY_LAYOUT
+        if library_layout and library_layout != stored_layout:
+            self.insert_setting("library_layout", library_layout)
+        self.library_dirs = {}  # {shard: directory}, one string shared by its entries
+        self.made_dirs = set()  # directories known to exist
+
+        self.url_refresher = BaseUrlRefresher(self.batch_get_base_urls)
+        # Videos get at most half of the downloads by default, images can use all of them
+        self.lanes = DownloadLanes(
+            thread_count,
+            image_threads or thread_count,
+            video_threads or max(1, thread_count // 2),
+            priority,
+        )
+        self.engine = engine
+        if engine == "async":
+            # thread_count is the amount of concurrent downloads on the event loop
+            from gparch_async import AsyncDownloadScheduler
+
+            self.scheduler = AsyncDownloadScheduler(
+                self, thread_count, self.insert_media_item, self.metrics, self.lanes
+            )
+        else:
+            self.scheduler = DownloadScheduler(
+                self.download_media_item,
+                thread_count,
+                self.insert_media_item,
+                self.metrics,
+                self.lanes,
+            )
+
+        # Transient failures are retried, and throttling lowers how many downloads
+        # and API requests run at once until the server recovers
+        self.download_retry = RetryPolicy(
+            AdaptiveConcurrency(thread_count),
+            self.scheduler.stopping,
+            lambda retried, throttled: self.record_retry(
+                "download", retried, throttled
+            ),
+        )
+        self.api_retry = RetryPolicy(
+            AdaptiveConcurrency(api_concurrency),
+            self.scheduler.stopping,
+            lambda retried, throttled: self.record_retry("api", retried, throttled),
+        )
+
+        # Rate limits shared by every download thread (bytes/s) and API call (requests/s)
+        self.bandwidth_limiter = TokenBucket(
+            bandwidth_schedule, self.scheduler.stopping
+        )
+        self.api_limiter = TokenBucket(api_qps_schedule, self.scheduler.stopping)
+
+    def record_retry(self, kind, retried, throttled):
+        phase = getattr(self.scheduler.local, "phase", None)
+        labels = {"kind": kind, "phase": phase.kind if phase else "listing"}
+        if retried:
+            self.metrics.increment("retries_total", **labels)
+        if throttled:
+            self.metrics.increment("throttled_total", **labels)
+
+    def collect_metrics(self):
+        """
+        Copies the stats kept outside of self.metrics into it before an export
+        """
+        requests_made, connections, reused = self.get_transport_stats()
+        self.metrics.set("connections_opened_total", connections, counter=True)
+        self.metrics.set("connections_reused_total", reused, counter=True)
+        self.metrics.set("sqlite_seconds_total", self.writer.seconds, counter=True)
+        self.metrics.set("elapsed_seconds", time() - self.timer)
+        limiters = (("bandwidth", self.bandwidth_limiter), ("api", self.api_limiter))
+        for name, limiter in limiters:
+            self.metrics.set(
+                "rate_limited_seconds_total", limiter.waited, counter=True, limiter=name
+            )
+
+    def start_metrics_writer(self, interval, json_path=None, prometheus_path=None):
+        self.metrics_writer = MetricsWriter(
+            self.metrics, interval, json_path, prometheus_path
+        )
+
+    def write_metrics(self, json_path=None, prometheus_path=None):
+        self.metrics.write(json_path, prometheus_path)
+
+    def get_discovery_document(self):
+        """
+        Returns the Photos Library API discovery document, cached in the base directory
+        - the cache is invalidated when it is older than DISCOVERY_CACHE_MAX_AGE, or when
+          the program version or DISCOVERY_CACHE_VERSION changes
+        - a stale cache is still used if a fresh document can't be downloaded
+        """
+        import httplib2
+
+        cache_path = self.base_dir + "/" + DISCOVERY_CACHE_NAME
+        try:
+            cache = load_json(cache_path)
+        except ValueError:
+            cache = None  # Corrupt cache, download it again
+        if (
+            cache
+            and cache.get("cache_version") == DISCOVERY_CACHE_VERSION
+            and cache.get("app_version") == VERSION
+            and time() - cache.get("fetched", 0) < DISCOVERY_CACHE_MAX_AGE
+        ):
+            return cache["document"]
+
+        try:
+            response, content = httplib2.Http(timeout=30).request(DISCOVERY_URL)
+            if response.status != 200:
+                raise httplib2.HttpLib2Error(
+                    f"discovery document request failed with HTTP {response.status}"
+                )
+            document = json.loads(content)
+        except (httplib2.HttpLib2Error, OSError, ValueError):
+            if cache and "document" in cache:
+                return cache["document"]
+            raise
+
+        cache = {
+            "cache_version": DISCOVERY_CACHE_VERSION,
+            "app_version": VERSION,
+            "fetched": time(),
+            "document": document,
+        }
+        with open(cache_path + ".tmp", "w") as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(cache_path + ".tmp", cache_path)
+        return document
+
     def get_google_api_service(self):
+        from google.auth.transport.requests import Request
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from googleapiclient.discovery import build_from_document
+
         # The file photos_token.pickle stores the user's access and refresh tokens, and is
         # created automatically when the authorization flow completes for the first time.
         credentials = None
@@ -175,179 +1910,1265 @@ class PhotosAccount(object):
             with open(token_path, "wb") as token:
                 pickle.dump(credentials, token)
 
-        self.service = build(
-            "photoslibrary", "v1", credentials=credentials, static_discovery=False
+        self.google_credentials = credentials
+        self.service = build_from_document(
+            self.get_discovery_document(), credentials=credentials
         )
 
-    def init_db(self):
-        if not os.path.exists(self.db_path):
-            con = sqlite3.connect(self.db_path)
-            cur = con.cursor()
-            # Create Media Table - Used to store basic information about each media item
-            cur.execute(
-                """CREATE TABLE media (uuid text, path text, album_uuid text)"""
-            )
-            # Create Albums Table - Used to store information about each album
-            cur.execute(
-                """CREATE TABLE albums (uuid text, path text, title text, is_shared integer)"""
+    def batch_get_media_items(self, uuids):
+        """
+        Returns a {uuid: mediaItem} dict of freshly listed media items (BATCH_GET_SIZE ids max)
+        - ids that aren't in the library anymore are left out
+        """
+        with self.metrics.timer("api_page_seconds", API_BUCKETS, method="batchGet"):
+            response = self.api_retry.run(
+                lambda: self.execute_api_request(
+                    self.service.mediaItems().batchGet(mediaItemIds=uuids)
+                )
             )
-            con.commit()  # Save changes
-            return con
-        else:
-            return sqlite3.connect(self.db_path)
+        return {
+            result["mediaItem"]["id"]: result["mediaItem"]
+            for result in response.get("mediaItemResults", [])
+            if "mediaItem" in result
+        }
 
-    def get_session_stats(self):
-        return time() - self.timer, self.downloads
+    def batch_get_base_urls(self, uuids):
+        """
+        Returns a {uuid: baseUrl} dict of freshly resolved baseUrls (BATCH_GET_SIZE ids max)
+        """
+        return {
+            uuid: item["baseUrl"]
+            for uuid, item in self.batch_get_media_items(uuids).items()
+        }
 
-    def download_media_item(self, entry):
-        try:
-            uuid, album_uuid, url, path, description = entry
-            if not os.path.isfile(path):
-                r = requests.get(url)
-                if r.status_code == 200:
-                    path = auto_filename(path)
-                    if description:
-                        try:
-                            img = Image.open(io.BytesIO(r.content))
-                            exif_dict = piexif.load(img.info["exif"])
-                            exif_dict["Exif"][
-                                piexif.ExifIFD.UserComment
-                            ] = piexif.helper.UserComment.dump(
-                                description, encoding="unicode"
-                            )
+    def execute_api_request(self, request):
+        """
+        Executes an API request on the calling thread's http object once the API rate limit allows
+        """
+        self.api_limiter.acquire()
+        self.metrics.increment("api_requests_total")
+        return request.execute(http=self.get_api_http())
+
+    def get_api_http(self):
+        """
+        Returns the calling thread's own http object for API requests
+        - httplib2 connections aren't thread safe, so API requests made from several
+          threads each execute with their own connection instead of the service's shared one
+        """
+        http = getattr(self.api_local, "http", None)
+        if http is None:
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+
+            http = httplib2.Http()
+            if self.google_credentials is not None:
+                http = AuthorizedHttp(self.google_credentials, http=http)
+            self.api_local.http = http
+        return http
 
-                            # This is a known bug with piexif (https://github.com/hMatoba/Piexif/issues/95)
-                            if 41729 in exif_dict["Exif"]:
-                                exif_dict["Exif"][41729] = bytes(
-                                    exif_dict["Exif"][41729]
-                                )
-
-                            exif_bytes = piexif.dump(exif_dict)
-                            img.save(path, exif=exif_bytes)
-                        except ValueError:
-                            # This value here is to catch a specific scenario with file extensions that have
-                            # descriptions that are unsupported by Pillow so the program can't modify the EXIF data.
-                            print(
-                                " [INFO] media file unsupported, can't write description to EXIF data."
-                            )
-                            open(path, "wb").write(r.content)
-                    else:
-                        open(path, "wb").write(r.content)
+    def init_db(self):
+        con = sqlite3.connect(self.db_path, check_same_thread=False)
+        # WAL lets readers run alongside the writer and makes each commit a cheap append
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        migrate_database(con)
+        return con
 
-                    self.downloads += 1
-                    return (
-                        uuid,
-                        path,
-                        album_uuid,
-                    )
+    def get_session_stats(self):
+        return time() - self.timer, self.metrics.get("items_total", result="downloaded")
+
+    def get_retry_stats(self):
+        """
+        Returns (download retries, download throttle events, API retries, API throttle events)
+        """
+        return (
+            self.download_retry.retries,
+            self.download_retry.throttled,
+            self.api_retry.retries,
+            self.api_retry.throttled,
+        )
 
-            else:
-                return False
-        except Exception as e:
-            print(" [ERROR] media item could not be downloaded because:", e)
-            return False
+    def get_rate_stats(self):
+        """
+        Returns (average download bytes/s, average API requests/s, seconds waited on the
+        bandwidth limit, seconds waited on the API limit) over the session
+        """
+        seconds = max(time() - self.timer, 1e-9)
+        return (
+            self.metrics.get("bytes_downloaded_total") / seconds,
+            self.metrics.get("api_requests_total") / seconds,
+            self.bandwidth_limiter.waited,
+            self.api_limiter.waited,
+        )
 
-    def download(self, entries, desc, thread_count):
-        result = ThreadPool(thread_count).imap_unordered(
-            self.download_media_item, entries
+    def get_dedupe_stats(self):
+        """
+        Returns (files linked to an identical file, bytes saved)
+        """
+        return (
+            self.metrics.get("deduplicated_total"),
+            self.metrics.get("deduplicated_bytes_total"),
         )
-        for downloaded_entry in tqdm(
-            result, unit=" media items", total=len(entries), desc=desc
-        ):
-            if downloaded_entry:
-                uuid, path, album_uuid = downloaded_entry
-                self.insert_media_item(
+
+    def get_transport_stats(self):
+        stats = self.transport.get_stats()
+        if self.engine == "async":
+            stats = tuple(map(sum, zip(stats, self.scheduler.get_stats())))
+        return stats
+
+    def wait_for_downloads(self):
+        self.scheduler.join()
+        self.save_library_sync()
+        self.writer.commit()
+
+    def close(self):
+        if self.metrics_writer is not None:
+            self.metrics_writer.stop()
+        self.scheduler.shutdown()
+        self.transport.close()
+        self.writer.stop()
+        self.con.close()
+
+    def write_description(self, path, description):
+        """
+        Writes the media item's description into the EXIF UserComment of the file at path
+        - JPEG and WebP files have only their EXIF segment rewritten
+        - every other format falls back to re-saving the image with Pillow
+        """
+        import piexif
+
+        with self.metrics.timer("exif_seconds", EXIF_BUCKETS):
+            try:
+                write_description_lossless(path, description)
+            except piexif.InvalidImageDataError:
+                write_description_reencode(path, description)
+
+    def get_resume_offset(self, uuid, part_path):
+        """
+        Returns how many bytes of a tracked partial download are already on disk (0 to start over)
+        """
+        expected_size = self.partials.get(uuid)
+        if expected_size is None or not os.path.isfile(part_path):
+            self.delete_partial(uuid)
+            return 0
+        offset = os.path.getsize(part_path)
+        if offset > expected_size:
+            self.delete_partial(uuid)
+            return 0
+        return offset
+
+    def start_part_file(
+        self, uuid, part_path, offset, status, headers, raise_for_status
+    ):
+        """
+        Checks the media server's response to a download and returns (file mode, sha256 hash
+        object, expected size) to stream the rest of the content into part_path with
+        - raise_for_status raises for any unsuccessful status that isn't worth retrying
+        - expected size is what part_path should hold once streamed, None if unknown
+        - shared by the thread and asyncio engines
+        """
+        if status in RETRY_STATUS_CODES:
+            raise TransientHTTPError(
+                status, parse_retry_after(headers.get("Retry-After"))
+            )
+        if status == 416:
+            # The partial download doesn't match the media item anymore, start over
+            self.delete_partial(uuid)
+            raise TransientHTTPError(status)
+        raise_for_status()
+
+        if status == 206 and offset:
+            expected_size = self.partials.get(uuid)
+            if parse_content_range(headers.get("Content-Range")) != (
+                offset,
+                expected_size,
+            ):
+                # The server resumed from somewhere else or the media item changed size,
+                # appending would splice two different files together, start over
+                self.delete_partial(uuid)
+                raise TransientHTTPError(status)
+            self.metrics.increment("resumed_total")
+            return "ab", hash_file(part_path, size=offset), expected_size
+
+        # Either a fresh download or the server ignored the Range header
+        expected_size = None
+        if headers.get("Content-Encoding", "identity") == "identity":
+            expected_size = int(headers.get("Content-Length", 0)) or None
+        if expected_size and expected_size >= RESUME_MIN_SIZE:
+            self.insert_partial(uuid, part_path, expected_size)
+        else:
+            self.delete_partial(uuid)
+        return "wb", hashlib.sha256(), expected_size
+
+    def check_part_size(self, part_path, expected_size):
+        """
+        Raises IncompleteDownloadError if the streamed part_path doesn't have the size the media
+        server announced, so a body cut short is never moved into place as a finished file
+        """
+        size = os.path.getsize(part_path)
+        if expected_size is not None and size != expected_size:
+            raise IncompleteDownloadError(
+                f"received {size} of {expected_size} bytes from the media server"
+            )
+
+    def stream_media_item(self, uuid, url, listed_at, part_path):
+        """
+        Streams the media item at url into part_path and returns the sha256 hash object of its content
+        - raises on any unsuccessful response
+        - large downloads are tracked in the partials table and continue from where an earlier
+          attempt (or run) stopped with a Range request, if the server honours it
+        """
+        offset = self.get_resume_offset(uuid, part_path)
+        if offset and offset == self.partials[uuid]:
+            # Already fully downloaded before being interrupted
+            return hash_file(part_path)
+        headers = {"Range": f"bytes={offset}-"} if offset else None
+        phase = getattr(self.scheduler.local, "phase", None)
+
+        # baseUrls expire about an hour after being listed, renew them when they are
+        # close to expiring and once more if the server rejects them anyway
+        url = self.url_refresher.get_url(uuid, url, listed_at)
+        r = self.transport.get(url, stream=True, headers=headers)
+        if r.status_code == 403:
+            r.close()
+            url = self.url_refresher.get_url(uuid, url, listed_at, force=True)
+            r = self.transport.get(url, stream=True, headers=headers)
+
+        with r:
+            mode, sha256, expected_size = self.start_part_file(
+                uuid, part_path, offset, r.status_code, r.headers, r.raise_for_status
+            )
+            with open(part_path, mode) as part_file:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if self.scheduler.stopping.is_set():
+                        raise InterruptedError("download cancelled")
+                    part_file.write(chunk)
+                    sha256.update(chunk)
+                    self.metrics.increment("bytes_downloaded_total", len(chunk))
+                    if phase:
+                        phase.add_bytes(len(chunk))
+                    self.bandwidth_limiter.acquire(len(chunk))
+                part_file.flush()
+                with self.metrics.timer("filesystem_seconds_total"):
+                    os.fsync(part_file.fileno())
+            self.check_part_size(part_path, expected_size)
+        return sha256
+
+    def save_media_item(
+        self, uuid, album_uuid, path, part_path, description, sha256, created=None
+    ):
+        """
+        Moves a completely streamed part_path to its final path and returns the result tuple
+        the download scheduler passes to insert_media_item
+        - writes the description into the file's EXIF data first
+        - shared by the thread and asyncio engines
+        """
+        if description:
+            # The description changes the file, so it can't be resumed past this point
+            self.delete_partial(uuid)
+            self.write_description(part_path, description)
+            sha256 = hash_file(part_path)
+
+        path = self.names.reserve(path)
+        try:
+            with self.metrics.timer("filesystem_seconds_total"):
+                os.replace(part_path, path)
+        except BaseException:
+            self.names.release(path)
+            raise
+        self.delete_partial(uuid)
+
+        sha256 = sha256.hexdigest()
+        self.link_duplicate(uuid, path, sha256)
+        stat = os.stat(path)
+
+        return (
+            uuid,
+            path,
+            album_uuid,
+            sha256,
+            stat.st_size,
+            stat.st_mtime,
+            created,
+        )
+
+    def remove_part_file(self, uuid, part_path):
+        # Tracked partial downloads are kept so they can be resumed later
+        if uuid not in self.partials and os.path.exists(part_path):
+            os.remove(part_path)
+
+    def download_media_item(self, entry):
+        try:
+            uuid, album_uuid, path, description = (
+                entry.uuid,
+                entry.album_uuid,
+                entry.path,
+                entry.description,
+            )
+            url, listed_at = entry.url, entry.listed_at
+            self.url_refresher.unregister(uuid)
+            with self.metrics.timer("filesystem_seconds_total"):
+                exists = os.path.isfile(path)
+            if exists:
+                return False
+            self.make_dir(os.path.dirname(path))
+
+            # Stream into a temporary file next to the final path and only move it
+            # into place once it is complete, so an interrupted download never
+            # leaves a truncated file behind that would be mistaken as finished
+            part_path = get_part_path(path, uuid)
+            try:
+                sha256 = self.download_retry.run(
+                    lambda: self.stream_media_item(uuid, url, listed_at, part_path)
+                )
+                return self.save_media_item(
                     uuid,
-                    path,
                     album_uuid,
+                    path,
+                    part_path,
+                    description,
+                    sha256,
+                    entry.created,
                 )
+            except BaseException:
+                self.remove_part_file(uuid, part_path)
+                raise
+        except Exception as e:
+            if not self.scheduler.stopping.is_set():
+                print(" [ERROR] media item could not be downloaded because:", e)
+            return None
+
+    def download(self, entries, desc, kind, album=None):
+        """
+        Submits entries to the session's download scheduler as a new phase and returns the phase
+        - entries can be any iterable, including a generator that is still listing pages
+          from the API, so downloading starts as soon as the first page arrives
+        - returns once every entry is queued, use wait_for_downloads to wait for them to finish
+        - in plan mode the entries are only added to self.plan (album is saved with them)
+        """
+        if self.plan is not None:
+            return self.plan_phase(entries, desc, kind, album)
+
+        phase = self.scheduler.start_phase(desc, kind)
+        try:
+            for entry in entries:
+                self.url_refresher.register(entry.uuid, entry.listed_at)
+                self.scheduler.submit(phase, entry)
+        finally:
+            phase.finish_listing()
+        return phase
+
+    def start_plan(self):
+        """
+        Switches the session to plan mode, every phase afterwards is listed into
+        self.plan instead of being downloaded
+        """
+        self.plan = SyncPlan(os.path.abspath(self.base_dir))
+        return self.plan
+
+    def plan_phase(self, entries, desc, kind, album=None):
+        phase = self.plan.add_phase(desc, kind, album)
+        for entry in entries:
+            phase["listed"] += 1
+            # Same check download_media_item makes before downloading
+            if not os.path.isfile(entry.path):
+                phase["entries"].append(entry)
+                phase["sizes"].append(None)
+        return phase
+
+    def get_media_size(self, entry):
+        """
+        Returns the size in bytes the media server reports for entry, or None
+        """
+        url = self.url_refresher.get_url(entry.uuid, entry.url, entry.listed_at)
+        try:
+            with self.transport.head(url) as r:
+                if r.ok and "Content-Length" in r.headers:
+                    return int(r.headers["Content-Length"])
+        except Exception as e:
+            if self.debug:
+                print(" [INFO] media size could not be checked because:", e)
+        return None
+
+    def estimate_plan(self, sample_size=PLAN_SAMPLE_SIZE):
+        """
+        Fills in the entry sizes of self.plan
+        - the size of up to sample_size random images and videos is checked with a HEAD
+          request, every other entry is estimated as the average of its type's sample
+        - sizes stay None when no sample of that type could be checked
+        """
+        by_type = {}
+        for phase in self.plan.phases:
+            for index, entry in enumerate(phase["entries"]):
+                media_type = "video" if entry.is_video else "image"
+                by_type.setdefault(media_type, []).append((phase, index))
+
+        samples = []
+        rng = random.Random(0)
+        for positions in by_type.values():
+            samples.extend(rng.sample(positions, min(sample_size, len(positions))))
+
+        entries = [phase["entries"][index] for phase, index in samples]
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            for (phase, index), size in zip(
+                samples, executor.map(self.get_media_size, entries)
+            ):
+                phase["sizes"][index] = size
+
+        for positions in by_type.values():
+            known = [
+                phase["sizes"][index]
+                for phase, index in positions
+                if phase["sizes"][index] is not None
+            ]
+            if not known:
+                continue
+            average = sum(known) // len(known)
+            for phase, index in positions:
+                if phase["sizes"][index] is None:
+                    phase["sizes"][index] = average
+
+    def replay_plan(self, plan):
+        """
+        Downloads everything in a SyncPlan without listing anything from the API
+        - albums that were new when planning get their directory now, entry paths are
+          moved along if the album ended up with a different directory name
+        - baseUrls in the plan have usually expired, they are renewed with batchGet
+        """
+        if plan.directory != os.path.abspath(self.base_dir):
+            raise ValueError(
+                f"the plan was made for another directory: {plan.directory}"
+            )
+        for phase in plan.phases:
+            entries = phase["entries"]
+            album = phase["album"]
+            if album and album["new"] and not self.select_album(album["id"]):
+                album_path = self.make_album_dir(album["path"])
+                self.insert_album(
+                    album["id"], album_path, album["title"], album["shared"]
+                )
+                if album_path != album["path"]:
+                    prefix = album["path"] + "/"
+                    for entry in entries:
+                        if entry.path.startswith(prefix):
+                            entry.filename = entry.path[len(prefix) :]
+                            entry.directory = album_path
+            self.claimed_media.update(entry.uuid for entry in entries)
+            self.download(entries, phase["desc"], phase["kind"])
+
+    def load_known_media(self):
+        """
+        Loads every downloaded media item as a {uuid: path} dict so items can be resolved
+        without a database query each (roughly 28 MB per 100k items with typical paths)
+        """
+        with self.writer.lock:
+            return dict(self.cur.execute("""SELECT uuid, path FROM media"""))
+
+    def load_partials(self):
+        """
+        Loads the expected sizes of resumable downloads as a {uuid: expected_size} dict
+        """
+        with self.writer.lock:
+            return dict(
+                self.cur.execute("""SELECT uuid, expected_size FROM partials""")
+            )
+
+    def insert_partial(self, uuid, part_path, expected_size):
+        # Committed right away so the download can be resumed even if the program is killed
+        self.partials[uuid] = expected_size
+        self.writer.execute(
+            """INSERT OR REPLACE INTO partials (uuid, part_path, expected_size) VALUES (?, ?, ?)""",
+            (uuid, part_path, expected_size),
+            commit=True,
+        )
+
+    def delete_partial(self, uuid):
+        if self.partials.pop(uuid, None) is not None:
+            self.writer.execute("""DELETE FROM partials WHERE uuid=?""", (uuid,))
 
     def select_media_item(self, uuid):
-        return self.cur.execute(
-            """SELECT * FROM media WHERE uuid=?""", (uuid,)
-        ).fetchone()
+        with self.writer.lock:
+            return self.cur.execute(
+                """SELECT * FROM media WHERE uuid=?""", (uuid,)
+            ).fetchone()
+
+    def insert_media_item(
+        self, uuid, path, album_uuid, sha256=None, size=None, mtime=None, created=None
+    ):
+        # Files that went missing are downloaded again, so replace their existing row
+        self.writer.execute(
+            """INSERT INTO media (uuid, path, album_uuid, sha256, size, mtime, created)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (uuid) DO UPDATE SET
+            path=excluded.path, album_uuid=excluded.album_uuid, sha256=excluded.sha256,
+            size=excluded.size, mtime=excluded.mtime,
+            created=COALESCE(excluded.created, media.created)""",
+            (uuid, path, album_uuid, sha256, size, mtime, created),
+        )
+        self.known_media[uuid] = path
+        if uuid in self.redownloads:
+            self.redownloads.pop(uuid, None)
+            self.writer.execute("""DELETE FROM redownloads WHERE uuid=?""", (uuid,))
+
+    def load_redownloads(self):
+        """
+        Loads the media queued to be downloaded again as a {uuid: reason} dict
+        """
+        with self.writer.lock:
+            return dict(self.cur.execute("""SELECT uuid, reason FROM redownloads"""))
+
+    def queue_redownload(self, uuid, reason):
+        self.redownloads[uuid] = reason
+        self.writer.execute(
+            """INSERT INTO redownloads (uuid, reason) VALUES (?, ?)
+            ON CONFLICT (uuid) DO UPDATE SET reason=excluded.reason""",
+            (uuid, reason),
+        )
 
-    def insert_media_item(self, uuid, path, album_uuid):
-        self.cur.execute(
-            """INSERT INTO media VALUES (?, ?, ?)""", (uuid, path, album_uuid)
+    def quarantine_file(self, uuid, path):
+        """
+        Moves a corrupt file out of the archive (into QUARANTINE_NAME) so it is downloaded again
+        """
+        quarantine_dir = os.path.join(self.base_dir, QUARANTINE_NAME)
+        safe_mkdir(quarantine_dir)
+        os.replace(
+            path, os.path.join(quarantine_dir, uuid + "_" + os.path.basename(path))
         )
-        self.con.commit()
+
+    def verify_archive(self, hashes=False, full=False):
+        """
+        Checks that every file in the media table still exists and is intact
+        - the archive is walked once with os.scandir instead of checking each file
+        - files whose size and modification time match the last time they were known to be
+          intact are skipped, unless full is set
+        - the size of every other file is compared, and with hashes its content hash too
+          (computed in a process pool)
+        - missing files are queued to be downloaded again, corrupt files are also moved
+          to the quarantine so the next sync replaces them
+        - returns {"unchanged", "verified", "missing", "corrupt", "untracked"} file counts
+        """
+        files = {}
+        for directory in (
+            self.lib_dir,
+            self.albums_dir,
+            self.shared_albums_dir,
+            self.favorites_dir,
+        ):
+            for path, stat in scan_files(directory).items():
+                files[os.path.normcase(os.path.abspath(path))] = stat
+
+        with self.writer.lock:
+            rows = self.cur.execute(
+                """SELECT uuid, path, sha256, size, mtime FROM media"""
+            ).fetchall()
+
+        counts = dict.fromkeys(("unchanged", "verified", "missing", "corrupt"), 0)
+        to_hash = []
+        tracked = set()
+        for uuid, path, sha256, size, mtime in tqdm(
+            rows, unit=" files", desc="Checking Archive"
+        ):
+            key = os.path.normcase(os.path.abspath(path))
+            tracked.add(key)
+            stat = files.get(key)
+            if stat is None:
+                counts["missing"] += 1
+                self.queue_redownload(uuid, "missing")
+            elif not full and (stat.st_size, stat.st_mtime) == (size, mtime):
+                counts["unchanged"] += 1
+            elif size is not None and stat.st_size != size:
+                counts["corrupt"] += 1
+                self.quarantine_file(uuid, path)
+                self.queue_redownload(uuid, "size")
+            elif hashes and sha256:
+                to_hash.append((uuid, path, sha256, stat))
+            else:
+                counts["verified"] += 1
+                if not sha256:
+                    # No hash to check the content against later, the file becomes
+                    # the known good state (hashed files wait for a hash check)
+                    self.update_media_stat(uuid, stat)
+
+        with ProcessPoolExecutor() as executor:
+            results = executor.map(
+                hash_file_hex, [row[1] for row in to_hash], chunksize=8
+            )
+            for (uuid, path, sha256, stat), file_sha256 in tqdm(
+                zip(to_hash, results),
+                total=len(to_hash),
+                unit=" files",
+                desc="Hashing Archive",
+            ):
+                if file_sha256 == sha256:
+                    counts["verified"] += 1
+                    self.update_media_stat(uuid, stat)
+                else:
+                    counts["corrupt"] += 1
+                    self.quarantine_file(uuid, path)
+                    self.queue_redownload(uuid, "hash")
+
+        self.writer.commit()
+        counts["untracked"] = len(files.keys() - tracked)
+        return counts
+
+    def update_media_stat(self, uuid, stat):
+        self.writer.execute(
+            """UPDATE media SET size=?, mtime=? WHERE uuid=?""",
+            (stat.st_size, stat.st_mtime, uuid),
+        )
+
+    def download_redownloads(self):
+        """
+        Downloads the media verify queued again to the path it was archived at
+        - media that a phase of this session already listed is downloaded by that phase
+        - media that isn't in Google Photos anymore is dropped from the queue (unless planning)
+        """
+        queued = [uuid for uuid in self.redownloads if uuid not in self.claimed_media]
+        self.claimed_media.update(queued)
+
+        def iter_queued():
+            for start in range(0, len(queued), BATCH_GET_SIZE):
+                uuids = queued[start : start + BATCH_GET_SIZE]
+                listed_at = time()
+                items = self.batch_get_media_items(uuids)
+                for uuid in uuids:
+                    item = items.get(uuid)
+                    row = self.select_media_item(uuid)
+                    if item is None or row is None:
+                        print(
+                            f" [INFO] {uuid} is no longer in Google Photos, "
+                            "not downloading it again."
+                        )
+                        if self.plan is None:
+                            # A dry run leaves the queue as it is
+                            self.redownloads.pop(uuid, None)
+                            self.writer.execute(
+                                """DELETE FROM redownloads WHERE uuid=?""", (uuid,)
+                            )
+                        continue
+                    entry = MediaEntry.from_media_item(item, listed_at)
+                    if entry is not None:
+                        entry.filename, entry.album_uuid = row[1], row[2]
+                        yield entry
+
+        self.download(iter_queued(), "Downloading Repaired Media", "repair")
+
+    def select_duplicate_path(self, uuid, sha256):
+        """
+        Returns the path of another downloaded media item with identical content, or None
+        """
+        with self.writer.lock:
+            for (path,) in self.cur.execute(
+                """SELECT path FROM media WHERE sha256=? AND uuid!=?""", (sha256, uuid)
+            ):
+                if os.path.isfile(path):
+                    return path
+        return None
+
+    def link_duplicate(self, uuid, path, sha256):
+        """
+        Stores a freshly downloaded file only once if identical content was already downloaded
+        (shared album copies, re-uploads...) by linking it to the existing file
+        """
+        if self.link_mode == "off":
+            return
+        duplicate_path = self.select_duplicate_path(uuid, sha256)
+        if duplicate_path and os.path.getsize(duplicate_path) == os.path.getsize(path):
+            size = os.path.getsize(path)
+            if link_file(duplicate_path, path, self.link_mode):
+                self.metrics.increment("deduplicated_total")
+                self.metrics.increment("deduplicated_bytes_total", size)
+
+    def dedupe_archive(self):
+        """
+        Offline pass that links every identical file already in the archive to a single copy
+        - files downloaded before content hashes were recorded are hashed first
+        - files that can't be read (or vanish during the pass) are skipped
+        - with link_mode "off" duplicates are only counted
+        - returns {"duplicates", "bytes"}, the identical copies found that weren't linked to
+          their original yet and their size
+        """
+        with self.writer.lock:
+            unhashed = self.cur.execute(
+                """SELECT uuid, path FROM media WHERE sha256 IS NULL"""
+            ).fetchall()
+        unhashed = [(uuid, path) for uuid, path in unhashed if os.path.isfile(path)]
+
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            hashes = executor.map(hash_file_hex, [path for uuid, path in unhashed])
+            for (uuid, path), sha256 in tqdm(
+                zip(unhashed, hashes),
+                total=len(unhashed),
+                unit=" files",
+                desc="Hashing Archive",
+            ):
+                if sha256 is None:
+                    continue  # Left unhashed for the next pass
+                self.writer.execute(
+                    """UPDATE media SET sha256=? WHERE uuid=?""", (sha256, uuid)
+                )
+        self.writer.commit()
+
+        with self.writer.lock:
+            rows = self.cur.execute(
+                """SELECT sha256, path FROM media WHERE sha256 IN
+                (SELECT sha256 FROM media WHERE sha256 IS NOT NULL
+                GROUP BY sha256 HAVING COUNT(*) > 1) ORDER BY sha256, rowid"""
+            ).fetchall()
+
+        originals = {}
+        counts = {"duplicates": 0, "bytes": 0}
+        for sha256, path in tqdm(rows, unit=" files", desc="Linking Duplicates"):
+            if not os.path.isfile(path):
+                continue
+            original = originals.setdefault(sha256, path)
+            try:
+                size = os.path.getsize(path)
+                if (
+                    original == path
+                    or os.path.getsize(original) != size
+                    or os.path.samefile(original, path)
+                ):
+                    continue
+                counts["duplicates"] += 1
+                counts["bytes"] += size
+                linked = link_file(original, path, self.link_mode)
+            except OSError:
+                continue  # Removed since it was hashed
+            if linked:
+                self.metrics.increment("deduplicated_total")
+                self.metrics.increment("deduplicated_bytes_total", size)
+        return counts
 
     def select_album(self, uuid):
-        return self.cur.execute(
-            """SELECT * FROM albums WHERE uuid=?""", (uuid,)
-        ).fetchone()
+        with self.writer.lock:
+            return self.cur.execute(
+                """SELECT * FROM albums WHERE uuid=?""", (uuid,)
+            ).fetchone()
 
     def insert_album(self, uuid, path, title, is_shared=False):
-        self.cur.execute(
-            """INSERT INTO albums VALUES (?, ?, ?, ?)""", (uuid, path, title, is_shared)
+        self.writer.execute(
+            """INSERT INTO albums (uuid, path, title, is_shared) VALUES (?, ?, ?, ?)""",
+            (uuid, path, title, is_shared),
+            commit=True,
         )
-        self.con.commit()
 
-    def process_media_items(self, media_items, save_directory, album_uuid=None):
-        media = []
-        for item in media_items:
-            # Path where the media item will be saved to
-            item_path = None
+    def select_sync_state(self, name):
+        with self.writer.lock:
+            row = self.cur.execute(
+                """SELECT value FROM sync_state WHERE name=?""", (name,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def insert_sync_state(self, name, value):
+        self.writer.execute(
+            """INSERT INTO sync_state (name, value) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET value=excluded.value""",
+            (name, value),
+            commit=True,
+        )
 
-            # Select the media item from the database
+    def select_setting(self, name):
+        with self.writer.lock:
+            row = self.cur.execute(
+                """SELECT value FROM settings WHERE name=?""", (name,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def insert_setting(self, name, value):
+        self.writer.execute(
+            """INSERT INTO settings (name, value) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET value=excluded.value""",
+            (name, value),
+            commit=True,
+        )
+
+    def save_library_sync(self):
+        """
+        Moves the library watermarks forward once every download of the library phase succeeded
+        - a failed or interrupted sync keeps the old watermark so its items are listed again
+        """
+        if self.library_sync is None:
+            return
+        started_at, full_sync, phase = self.library_sync
+        if not phase.done.is_set() or phase.failed or self.scheduler.stopping.is_set():
+            return
+        self.library_sync = None
+        self.insert_sync_state("library_synced_at", started_at)
+        if full_sync:
+            self.insert_sync_state("library_full_synced_at", started_at)
+
+    def process_media_items(self, entries, save_directory, album_uuid=None):
+        """
+        Generator resolving the path of each listed MediaEntry and yielding the ones
+        this phase should download, one at a time
+        - save_directory can also be a function returning the directory of an entry
+        """
+        for entry in entries:
+            # Media items are only saved in one location, the first phase to list an item
+            # keeps it so items are stored in the most specific place possible
+            if entry.uuid in self.claimed_media:
+                continue
+            self.claimed_media.add(entry.uuid)
+
+            # Look up the media item in the known media index
             # -> if it doesn't exist then generate the item_path
-            # -> if it already exists then just pull the item_path from the existing db entry
-            item_db_entry = self.select_media_item(item["id"])
-            if not item_db_entry:
-                item["filename"] = sanitize(item["filename"])
-                item_path = f'{save_directory}/{item["filename"]}'
+            # -> if it already exists then just pull the item_path from the existing entry
+            item_path = self.known_media.get(entry.uuid)
+            if item_path is None:
+                entry.directory = (
+                    save_directory(entry.uuid, entry.created)
+                    if callable(save_directory)
+                    else save_directory
+                )
+                entry.filename = sanitize(entry.filename)
             else:
-                item_path = item_db_entry[1]
+                entry.directory = None
+                entry.filename = item_path
+            entry.album_uuid = album_uuid
+            yield entry
+
+    def download_library(
+        self,
+        incremental=False,
+        overlap_days=DEFAULT_OVERLAP_DAYS,
+        full_sync_days=DEFAULT_FULL_SYNC_DAYS,
+    ):
+        """
+        Downloads the library, or with incremental only the media created since the last
+        successful library sync (minus overlap_days)
+        - incremental falls back to a full sync when there is no watermark yet, or when the
+          last full sync is more than full_sync_days old (if full_sync_days is set)
+        """
+        started_at = time()
+        since = None
+        if incremental:
+            synced_at = self.select_sync_state("library_synced_at")
+            full_synced_at = self.select_sync_state("library_full_synced_at")
+            full_sync_due = full_sync_days and (
+                full_synced_at is None
+                or started_at - full_synced_at > full_sync_days * 86400
+            )
+            if synced_at is not None and not full_sync_due:
+                since = synced_at - overlap_days * 86400
 
-            # Set description to none if not there so a key error won't occur below
-            #   This keeps the code simpler when dealing with descriptions
-            if "description" not in item:
-                item["description"] = None
+        if since is None:
+            media_items = self.iter_media_items()
+            desc = "Downloading Library"
+        else:
+            media_items = self.iter_media_items_since(since)
+            since_date = datetime.fromtimestamp(since, timezone.utc)
+            desc = f"Downloading Library (since {since_date:%Y-%m-%d})"
+        phase = self.download(
+            self.process_media_items(iter_entries(media_items), self.get_library_dir),
+            desc,
+            "library",
+        )
+        if self.plan is None:
+            self.library_sync = (started_at, since is None, phase)
+
+    def get_library_dir(self, uuid, created):
+        """
+        Returns the directory in Library/ a media item is saved to with the archive's layout
+        """
+        shard = get_library_shard(self.library_layout, uuid, created)
+        directory = self.library_dirs.get(shard)
+        if directory is None:
+            directory = self.lib_dir + "/" + shard if shard else self.lib_dir
+            self.library_dirs[shard] = directory
+        return directory
+
+    def make_dir(self, directory):
+        """
+        Creates directory if it doesn't exist yet (Library shards are made when first used)
+        """
+        if directory not in self.made_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.made_dirs.add(directory)
+
+    def migrate_library_layout(self, layout):
+        """
+        Moves the media files already in Library/ into the directories of layout, records
+        their new paths and makes layout the archive's layout
+        - the date layout needs creation times, the ones not recorded yet (media downloaded
+          by older versions) are looked up with mediaItems.batchGet, so it needs the API
+        - the path updates are committed DB_BATCH_SIZE rows at a time by DatabaseWriter
+        - files that are missing are left for verify, running it again resumes the migration
+          and finds the files an interrupted run moved under their original name
+        - returns (moved, missing) file counts
+        """
+        library_key = os.path.normcase(os.path.abspath(self.lib_dir)) + os.sep
+        with self.writer.lock:
+            rows = [
+                row
+                for row in self.cur.execute("""SELECT uuid, path, created FROM media""")
+                if os.path.normcase(os.path.abspath(row[1])).startswith(library_key)
+            ]
+
+        if layout == "date":
+            undated = [uuid for uuid, _, created in rows if created is None]
+            if undated and self.service is None:
+                self.get_google_api_service()
+            created_at = {}
+            for start in tqdm(
+                range(0, len(undated), BATCH_GET_SIZE),
+                unit=" requests",
+                desc="Looking Up Creation Dates",
+            ):
+                uuids = undated[start : start + BATCH_GET_SIZE]
+                for uuid, item in self.batch_get_media_items(uuids).items():
+                    entry = MediaEntry.from_media_item(item)
+                    if entry is not None and entry.created is not None:
+                        created_at[uuid] = entry.created
+                        self.writer.execute(
+                            """UPDATE media SET created=? WHERE uuid=?""",
+                            (entry.created, uuid),
+                        )
+            rows = [
+                (uuid, path, created_at.get(uuid, created))
+                for uuid, path, created in rows
+            ]
+
+        self.library_layout = layout
+        self.library_dirs = {}
+        # Paths recorded for other media, which a file found by its name can't be
+        claimed = {os.path.normcase(path) for _, path, _ in rows}
+        moved = missing = 0
+        for uuid, path, created in tqdm(rows, unit=" files", desc="Moving Library"):
+            directory = self.get_library_dir(uuid, created)
+            if os.path.normcase(os.path.dirname(path)) == os.path.normcase(directory):
+                continue
+            new_path = directory + "/" + os.path.basename(path)
+            if not os.path.isfile(path):
+                # Moved by an interrupted migration before its path update was committed
+                found = os.path.normcase(new_path) not in claimed
+                if not (found and os.path.isfile(new_path)):
+                    missing += 1
+                    continue
+            else:
+                self.make_dir(directory)
+                new_path = self.names.reserve(new_path)
+                with self.metrics.timer("filesystem_seconds_total"):
+                    os.replace(path, new_path)
+            claimed.add(os.path.normcase(new_path))
+            self.writer.execute(
+                """UPDATE media SET path=? WHERE uuid=?""", (new_path, uuid)
+            )
+            self.known_media[uuid] = new_path
+            moved += 1
+        self.insert_setting("library_layout", layout)
+
+        remove_empty_dirs(self.lib_dir)
+        return moved, missing
+
+    def detect_library_layout(self):
+        """
+        Returns the layout the directories in Library/ were made by
+        """
+        with os.scandir(self.lib_dir) as entries:
+            names = [
+                entry.name
+                for entry in entries
+                if entry.is_dir() and not entry.name.startswith(".")
+            ]
+        if any(re.fullmatch(r"\d{4}", name) or name == "Undated" for name in names):
+            return "date"
+        if names and all(re.fullmatch(r"[0-9a-f]{2}", name) for name in names):
+            return "hash"
+        return "flat"
+
+    def match_files(self, entries, files, save_directory):
+        """
+        Matches listed entries to the files ({path: os.stat_result}) a phase saving them to
+        save_directory (a path, or a function like get_library_dir) would have downloaded
+        - an entry matches a file with its sanitized filename, or that name with a (#),
+          files named exactly like an entry are tried first (a filename can end in (#) too)
+        - when a filename is shared, the sizes the media server reports (HEAD requests, made
+          in parallel) tell the files apart, the files left are matched in (#) order to the
+          entries whose size couldn't be checked or changed (a description was written)
+        - returns [(entry, path, os.stat_result)], matched files are removed from files
+        """
+        candidates = {}  # {(directory, name): [(#, path)]}, by exact and base name
+        for path in files:
+            directory, name = os.path.split(path)
+            directory = os.path.normcase(directory)
+            base, number = get_base_name(name)
+            candidates.setdefault((directory, os.path.normcase(base)), []).append(
+                (number, path)
+            )
+            if number:
+                candidates.setdefault((directory, os.path.normcase(name)), []).append(
+                    (0, path)
+                )
 
-            # Process Media
-            # - Image
-            if "image" in item["mimeType"]:
-                media.append(
-                    (
-                        item["id"],
-                        album_uuid,
-                        item["baseUrl"] + "=d",
-                        item_path,
-                        item["description"],
+        groups = {}  # {(directory, name): [entries]} in listing order
+        for entry in entries:
+            directory = (
+                save_directory(entry.uuid, entry.created)
+                if callable(save_directory)
+                else save_directory
+            )
+            key = (
+                os.path.normcase(directory),
+                os.path.normcase(sanitize(entry.filename)),
+            )
+            if key in candidates:
+                groups.setdefault(key, []).append(entry)
+
+        shared = [
+            entry
+            for key, group in groups.items()
+            if len(group) > 1 or len(candidates[key]) > 1
+            for entry in group
+        ]
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            sizes = dict(
+                zip(
+                    (entry.uuid for entry in shared),
+                    tqdm(
+                        executor.map(self.get_media_size, shared),
+                        total=len(shared),
+                        unit=" media items",
+                        desc="Checking Shared Filenames",
+                        disable=not shared,
+                    ),
+                )
+            )
+
+        matches = []
+        matched = set()
+        # Files with the exact name first, then the ones with a (#) left by then
+        for exact in (True, False):
+            for key, group in groups.items():
+                remaining = [
+                    path
+                    for number, path in sorted(candidates[key])
+                    if path in files and not (exact and number)
+                ]
+                unsized = []
+                for entry in group:
+                    if entry.uuid in matched:
+                        continue
+                    size = sizes.get(entry.uuid)
+                    path = next(
+                        (path for path in remaining if files[path].st_size == size),
+                        None,
                     )
+                    if path is not None:
+                        remaining.remove(path)
+                        matches.append((entry, path, files.pop(path)))
+                        matched.add(entry.uuid)
+                    elif size is None or entry.description:
+                        unsized.append(entry)
+                for entry, path in zip(unsized, remaining):
+                    matches.append((entry, path, files.pop(path)))
+                    matched.add(entry.uuid)
+        return matches
+
+    def reindex_archive(self):
+        """
+        Rebuilds the media and albums tables from the files already in the archive (e.g. after
+        the database was lost) so nothing has to be downloaded again
+        - the archive is walked once, its directories in parallel with os.scandir
+        - everything is listed in the same order a sync places it (favorites, albums, shared
+          albums, library) and matched to the files of the directory it would be saved to,
+          see match_files, albums are matched to directories by title in listing order
+        - rows are bulk loaded, the size and modification time of each file become the
+          verify baseline, content hashes are left to --dedupe and --verify-hashes
+        - media the database already has at the matched path is left as it is
+        - returns {"matched", "albums", "unmatched"} counts, unmatched files weren't listed
+          (deleted from Google Photos, or not downloaded by this program)
+        """
+        if self.select_setting("library_layout") is None:
+            self.library_layout = self.detect_library_layout()
+            self.insert_setting("library_layout", self.library_layout)
+        self.library_dirs = {}
+
+        album_dirs = {}  # {(shared, base title): [(#, path)]}
+        for shared, parent in (
+            (False, self.albums_dir),
+            (True, self.shared_albums_dir),
+        ):
+            with os.scandir(parent) as entries:
+                for entry in entries:
+                    if entry.is_dir() and not entry.name.startswith("."):
+                        base, number = get_base_name(entry.name, is_directory=True)
+                        album_dirs.setdefault(
+                            (shared, os.path.normcase(base)), []
+                        ).append((number, os.path.abspath(entry.path)))
+        for paths in album_dirs.values():
+            paths.sort()
+
+        # Album directories, Library/ itself and each of its subdirectories are walked in parallel
+        roots = [(self.favorites_dir, False), (self.lib_dir, False)]
+        roots += [(path, False) for paths in album_dirs.values() for _, path in paths]
+        with os.scandir(self.lib_dir) as entries:
+            roots += [
+                (self.lib_dir + "/" + entry.name, True)
+                for entry in entries
+                if entry.is_dir(follow_symlinks=False)
+                and not entry.name.startswith(".")
+            ]
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            scanned = dict(
+                zip(
+                    roots,
+                    tqdm(
+                        executor.map(lambda root: scan_files(*root), roots),
+                        total=len(roots),
+                        unit=" directories",
+                        desc="Scanning Archive",
+                    ),
                 )
-            # - Video
-            elif "video" in item["mimeType"]:
-                media.append(
+            )
+        total = sum(len(files) for files in scanned.values())
+        library_files = {}
+        for (root, recursive), files in scanned.items():
+            if root == self.lib_dir or recursive:
+                library_files.update(files)
+
+        rows = []
+        album_rows = []
+        matched = 0
+
+        def add_matches(matches, album_uuid=None):
+            nonlocal matched
+            matched += len(matches)
+            for entry, path, stat in matches:
+                self.claimed_media.add(entry.uuid)
+                if self.known_media.get(entry.uuid) == path:
+                    continue  # already in the database, keep its content hash
+                rows.append(
                     (
-                        item["id"],
+                        entry.uuid,
+                        path,
                         album_uuid,
-                        item["baseUrl"] + "=dv",
-                        item_path,
-                        item["description"],
+                        None,
+                        stat.st_size,
+                        stat.st_mtime,
+                        entry.created,
                     )
                 )
 
-        return media
+        def unclaimed(entries):
+            return [entry for entry in entries if entry.uuid not in self.claimed_media]
 
-    def download_library(self):
-        items = self.process_media_items(self.list_media_items(), self.lib_dir)
-        self.download(items, "Downloading Library", self.thread_count)
+        print("Matching Favorites...")
+        add_matches(
+            self.match_files(
+                list(iter_entries(self.iter_favorites())),
+                scanned[(self.favorites_dir, False)],
+                self.favorites_dir,
+            )
+        )
+        for shared, albums in (
+            (False, self.iter_albums()),
+            (True, self.iter_shared_albums()),
+        ):
+            print(f"Matching {'Shared ' if shared else ''}Albums...")
+            for album, album_items in self.prefetch_album_items(albums):
+                if "mediaItemsCount" not in album:
+                    continue
+                title = sanitize(album.get("title", "Unnamed Album"))
+                paths = album_dirs.get((shared, os.path.normcase(title)))
+                if not paths:
+                    continue  # never downloaded
+                album_path = paths.pop(0)[1]
+                album_rows.append((album["id"], album_path, title, shared))
+                if album_items is None:
+                    album_items = iter_entries(self.iter_album_items(album))
+                add_matches(
+                    self.match_files(
+                        unclaimed(album_items), scanned[(album_path, False)], album_path
+                    ),
+                    album["id"],
+                )
+        print("Matching Library...")
+        entries = unclaimed(iter_entries(self.iter_media_items()))
+        add_matches(self.match_files(entries, library_files, self.get_library_dir))
+        if self.library_layout != "flat":
+            # Files downloaded before the layout was changed (without --migrate-layout)
+            add_matches(
+                self.match_files(unclaimed(entries), library_files, self.lib_dir)
+            )
+
+        self.writer.executemany(
+            """INSERT INTO albums (uuid, path, title, is_shared) VALUES (?, ?, ?, ?)
+            ON CONFLICT (uuid) DO UPDATE SET
+            path=excluded.path, title=excluded.title, is_shared=excluded.is_shared""",
+            album_rows,
+        )
+        self.writer.executemany(
+            """INSERT INTO media (uuid, path, album_uuid, sha256, size, mtime, created)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (uuid) DO UPDATE SET
+            path=excluded.path, album_uuid=excluded.album_uuid, sha256=excluded.sha256,
+            size=excluded.size, mtime=excluded.mtime, created=excluded.created""",
+            rows,
+        )
+        self.known_media.update((row[0], row[1]) for row in rows)
+        return {
+            "matched": matched,
+            "albums": len(album_rows),
+            "unmatched": total - matched,
+        }
 
     def download_favorites(self):
-        items = self.process_media_items(self.search_favorites(), self.favorites_dir)
-        self.download(items, "Downloading Favorites", self.thread_count)
+        items = self.process_media_items(
+            iter_entries(self.iter_favorites()), self.favorites_dir
+        )
+        self.download(items, "Downloading Favorites", "favorites")
 
     def download_all_albums(self):
-        for album in self.list_albums():
-            self.download_single_album(album)
+        for album, album_items in self.prefetch_album_items(self.iter_albums()):
+            self.download_single_album(album, album_items=album_items)
 
     def download_all_shared_albums(self):
-        for album in self.list_shared_albums():
-            self.download_single_album(album, True)
+        for album, album_items in self.prefetch_album_items(self.iter_shared_albums()):
+            self.download_single_album(album, True, album_items)
+
+    def prefetch_album_items(self, albums):
+        """
+        Generator yielding (album, album_items) while listing up to api_concurrency albums in parallel
+        - albums are yielded in their original order so placement doesn't depend on timing
+        - album_items is None when api_concurrency is 1, the album is then listed as it downloads
+        """
+        if self.api_concurrency <= 1:
+            for album in albums:
+                yield album, None
+            return
 
-    def download_single_album(self, album, shared=False):
+        with ThreadPoolExecutor(
+            max_workers=self.api_concurrency, thread_name_prefix="api"
+        ) as executor:
+            pending = deque()
+            for album in albums:
+                if "mediaItemsCount" in album:
+                    future = executor.submit(
+                        lambda album: list(iter_entries(self.iter_album_items(album))),
+                        album,
+                    )
+                else:
+                    future = None  # download_single_album skips these
+                pending.append((album, future))
+
+                # Keep a bounded window of albums listed ahead of the one being downloaded
+                if len(pending) > self.api_concurrency * 2:
+                    album, future = pending.popleft()
+                    yield album, future.result() if future else []
+            while pending:
+                album, future = pending.popleft()
+                yield album, future.result() if future else []
+
+    def make_album_dir(self, path):
+        """
+        Creates a new album directory, appending a number -> (#) if the name is already taken
+        """
+        path = self.names.reserve(path, is_directory=True)
+        os.mkdir(path)
+        return os.path.abspath(path)
+
+    def download_single_album(self, album, shared=False, album_items=None):
         # Return if the album has no mediaItems to download
         # Unsure of how this occurs, but there are album entries that exist
         #   where there I don't have permission, weird bug...
@@ -361,32 +3182,6 @@ class PhotosAccount(object):
         # Sanitize album title
         album["title"] = sanitize(album["title"])
 
-        # Make request
-        album_items = []
-
-        request_body = {
-            "albumId": album["id"],
-            "pageSize": 100,  # Max is 100
-            "pageToken": "",
-        }
-        num = 0
-        request = (
-            self.service.mediaItems().search(body=request_body).execute()
-        )  # 100 is max
-        if not request:
-            return
-        while True:
-            if "mediaItems" in request:
-                album_items += request["mediaItems"]
-            if "nextPageToken" in request:
-                request_body["pageToken"] = request["nextPageToken"]
-                request = self.service.mediaItems().search(body=request_body).execute()
-            else:
-                break
-
-        if self.debug:
-            save_json(album_items, "debug/" + album["title"] + ".json")
-
         # Directory where the album exists
         album_path = None
 
@@ -396,125 +3191,151 @@ class PhotosAccount(object):
         album_db_entry = self.select_album(album["id"])
         if album_db_entry:
             album_path = album_db_entry[1]
+        elif self.plan is not None:
+            # Planning only reserves the name, the directory is made when the plan runs
+            album_path = os.path.abspath(
+                self.names.reserve(
+                    (self.shared_albums_dir if shared else self.albums_dir)
+                    + "/"
+                    + album["title"],
+                    is_directory=True,
+                )
+            )
         elif not shared:
-            album_path = auto_mkdir(self.albums_dir + "/" + album["title"])
+            album_path = self.make_album_dir(self.albums_dir + "/" + album["title"])
             self.insert_album(album["id"], album_path, album["title"], shared)
         else:
-            album_path = auto_mkdir(self.shared_albums_dir + "/" + album["title"])
+            album_path = self.make_album_dir(
+                self.shared_albums_dir + "/" + album["title"]
+            )
             self.insert_album(album["id"], album_path, album["title"], shared)
 
+        if album_items is None:
+            album_items = iter_entries(self.iter_album_items(album))
         processed_items = self.process_media_items(album_items, album_path, album["id"])
 
-        if processed_items:
-            self.download(
-                processed_items,
-                f"Downloading {'Shared ' if shared else ''}Album: \"{album['title']}\"",
-                self.thread_count,
-            )
-        else:
-            print(
-                f"Downloading {'Shared ' if shared else ''}Album: \"{album['title']}\""
-            )
-            print("Everything already downloaded.")
+        self.download(
+            processed_items,
+            f"Downloading {'Shared ' if shared else ''}Album: \"{album['title']}\"",
+            "shared_album" if shared else "album",
+            {
+                "id": album["id"],
+                "path": album_path,
+                "title": album["title"],
+                "shared": shared,
+                "new": not album_db_entry,
+            },
+        )
 
-    def list_media_items(self):
+    def iter_pages(self, make_request, debug_name):
+        """
+        Generator yielding each page of a paginated API listing as soon as it is received
+        - make_request(page_token) returns the request for a page (page_token is None for the first)
+        """
         num = 0
-        media_items_list = []
-        request = self.service.mediaItems().list(pageSize=100).execute()  # Max is 50
-        if not request:
-            return {}
+        page_token = None
         while True:
-            if self.debug:
-                save_json(request, "debug/media" + str(num) + ".json")
-            if "mediaItems" in request:
-                media_items_list += request["mediaItems"]
-            if "nextPageToken" in request:
-                next_page = request["nextPageToken"]
-                request = (
-                    self.service.mediaItems()
-                    .list(pageSize=100, pageToken=next_page)
-                    .execute()
+            with self.metrics.timer("api_page_seconds", API_BUCKETS, method="list"):
+                page = self.api_retry.run(
+                    lambda: self.execute_api_request(make_request(page_token))
                 )
-            else:
-                break
-            num += 1
-        if self.debug:
-            save_json(media_items_list, "debug/media_items_list.json")
-        return media_items_list
-
-    def list_albums(self):
-        num = 0
-        album_list = []
-        request = self.service.albums().list(pageSize=50).execute()  # Max is 50
-        if not request:
-            return {}
-        while True:
+            if not page:
+                return
             if self.debug:
-                save_json(request, "debug/albums" + str(num) + ".json")
-            if "albums" in request:
-                album_list += request["albums"]
-            if "nextPageToken" in request:
-                next_page = request["nextPageToken"]
-                request = (
-                    self.service.albums()
-                    .list(pageSize=50, pageToken=next_page)
-                    .execute()
-                )
-            else:
-                break
+                save_json(page, "debug/" + debug_name + str(num) + ".json")
+            yield page
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                return
             num += 1
-        if self.debug:
-            save_json(album_list, "debug/album_list.json")
-        return album_list
 
-    def list_shared_albums(self):
-        shared_album_list = []
-        request = self.service.sharedAlbums().list(pageSize=50).execute()  # Max is 50
-        num = 0
-        if not request:
-            return {}
-        while True:
-            if self.debug:
-                save_json(request, "debug/shared_albums" + str(num) + ".json")
-            shared_album_list += request["sharedAlbums"]
-            if "nextPageToken" in request:
-                next_page = request["nextPageToken"]
-                request = (
-                    self.service.sharedAlbums()
-                    .list(pageSize=50, pageToken=next_page)
-                    .execute()
-                )
-            else:
-                break
-            num += 1
-        if self.debug:
-            save_json(shared_album_list, "debug/shared_album_list.json")
-        return shared_album_list
+    def iter_media_items(self):
+        for page in self.iter_pages(
+            lambda page_token: self.service.mediaItems().list(
+                pageSize=100, pageToken=page_token  # Max is 100
+            ),
+            "media",
+        ):
+            yield from page.get("mediaItems", [])
+
+    def iter_albums(self):
+        for page in self.iter_pages(
+            lambda page_token: self.service.albums().list(
+                pageSize=50, pageToken=page_token  # Max is 50
+            ),
+            "albums",
+        ):
+            yield from page.get("albums", [])
+
+    def iter_shared_albums(self):
+        for page in self.iter_pages(
+            lambda page_token: self.service.sharedAlbums().list(
+                pageSize=50, pageToken=page_token  # Max is 50
+            ),
+            "shared_albums",
+        ):
+            yield from page.get("sharedAlbums", [])
 
-    def search_favorites(self):
-        # Form request body using media_types_list above
+    def iter_album_items(self, album):
+        request_body = {
+            "albumId": album["id"],
+            "pageSize": 100,  # Max is 100
+        }
+        for page in self.iter_pages(
+            lambda page_token: self.service.mediaItems().search(
+                body=dict(request_body, pageToken=page_token or "")
+            ),
+            sanitize(album.get("title", "Unnamed Album")),
+        ):
+            yield from page.get("mediaItems", [])
+
+    def iter_media_items_since(self, since):
+        """
+        Lists media items created on or after the UTC date of the since timestamp
+        """
+        start = datetime.fromtimestamp(since, timezone.utc)
+        # Creation dates are local to where the media was taken, so end a day late
+        end = datetime.now(timezone.utc) + timedelta(days=1)
+        request_body = {
+            "filters": {
+                "dateFilter": {
+                    "ranges": [
+                        {
+                            "startDate": {
+                                "year": start.year,
+                                "month": start.month,
+                                "day": start.day,
+                            },
+                            "endDate": {
+                                "year": end.year,
+                                "month": end.month,
+                                "day": end.day,
+                            },
+                        }
+                    ]
+                }
+            },
+            # Searches leave out archived media unless asked to, mediaItems.list doesn't
+            "includeArchivedMedia": True,
+            "pageSize": 100,  # Max is 100
+        }
+        for page in self.iter_pages(
+            lambda page_token: self.service.mediaItems().search(
+                body=dict(request_body, pageToken=page_token or "")
+            ),
+            "media_since",
+        ):
+            yield from page.get("mediaItems", [])
+
+    def iter_favorites(self):
         request_body = {
             "filters": {"featureFilter": {"includedFeatures": ["FAVORITES"]}},
             "pageSize": 100,  # Max is 100
-            "pageToken": "",
         }
-        num = 0
-        # Make request
-        favorites_list = []
-        request = self.service.mediaItems().search(body=request_body).execute()
-        if not request:
-            return {}
-        while True:
-            if self.debug:
-                save_json(request, "debug/favorites" + str(num) + ".json")
-            if "mediaItems" in request:
-                favorites_list += request["mediaItems"]
-            if "nextPageToken" in request:
-                request_body["pageToken"] = request["nextPageToken"]
-                request = self.service.mediaItems().search(body=request_body).execute()
-            else:
-                break
-            num += 1
-        if self.debug:
-            save_json(favorites_list, "debug/favorites_list.json")
-        return favorites_list
+        for page in self.iter_pages(
+            lambda page_token: self.service.mediaItems().search(
+                body=dict(request_body, pageToken=page_token or "")
+            ),
+            "favorites",
+        ):
+            yield from page.get("mediaItems", [])
@@ -0,0 +1,399 @@
+"""
+Asyncio Download Engine
+Archiver for Google Photos
+By: Nick Dawson | nick@ndawson.me
+
+"""
+
+"""
+    Archiver For Google Photos
+    - A tool to maintain an archive/mirror of your Google Photos library for backup purposes.
+    Copyright (C) 2021  Nicholas Dawson
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import aiohttp
+
+from gparch import (
+    DOWNLOAD_BUCKETS,
+    DOWNLOAD_CHUNK_SIZE,
+    DownloadPhase,
+    get_part_path,
+    hash_file,
+)
+
+# Phase of the download a coroutine (or the blocking work it hands off) is working on
+CURRENT_PHASE = contextvars.ContextVar("phase", default=None)
+
+
+class PhaseContext(object):
+    """
+    Stands in for DownloadScheduler.local, whose .phase is read when retries are recorded
+    """
+
+    @property
+    def phase(self):
+        return CURRENT_PHASE.get()
+
+
+class AsyncConcurrency(object):
+    """
+    Async context manager that follows the limit of an AdaptiveConcurrency (AIMD) limiter
+    - the limiter keeps deciding the limit, this only makes coroutines wait for a free slot
+      on the event loop instead of blocking a thread
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.condition = None  # created on the event loop
+        self.active = 0
+
+    async def __aenter__(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limiter.limit)
+            self.active += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+
+class AsyncDownloadScheduler(object):
+    """
+    Alternative to DownloadScheduler that runs every download as a coroutine on one asyncio
+    event loop (in its own thread) instead of on a thread each, so hundreds of downloads
+    can stream at once
+    - same interface as DownloadScheduler, PhotosAccount doesn't know which one it uses,
+      entries wait in the same DownloadLanes
+    - the skip rules, partial downloads, retries and saving are PhotosAccount's own, only
+      the streaming itself is done with aiohttp
+    - blocking work (EXIF descriptions, hashing resumed files, writing chunks, fsync,
+      database writes and baseUrl renewal) runs on a small thread pool off the event loop
+    """
+
+    def __init__(self, account, concurrency, on_result, metrics, lanes):
+        self.account = account
+        self.concurrency = concurrency
+        self.on_result = on_result
+        self.metrics = metrics
+        self.lanes = lanes
+        self.lanes_lock = threading.Lock()  # listing threads push to the lanes
+        self.local = PhaseContext()
+        self.executor = ThreadPoolExecutor(thread_name_prefix="blocking")
+        self.stopping = threading.Event()
+        self.phases = []
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="download-loop", daemon=True
+        )
+        self.thread.start()
+        self.call(self.open_session()).result()
+
+    def call(self, coroutine):
+        """
+        Schedules a coroutine on the event loop from any thread and returns its future
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def open_session(self):
+        self.ready = asyncio.Condition()  # notified when an entry finishes
+        self.limit = None  # AsyncConcurrency, made once the retry policy exists
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self.on_request_start)
+        trace.on_connection_create_end.append(self.on_connection_create_end)
+        connect_timeout, read_timeout = self.account.transport.timeout
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=connect_timeout, sock_read=read_timeout
+            ),
+            trace_configs=[trace],
+        )
+
+    async def on_request_start(self, *args):
+        with self.lock:
+            self.requests += 1
+
+    async def on_connection_create_end(self, *args):
+        with self.lock:
+            self.connections += 1
+
+    def get_stats(self):
+        """
+        Returns (requests, connections opened, connections reused) like PooledTransport.get_stats
+        """
+        with self.lock:
+            return self.requests, self.connections, self.requests - self.connections
+
+    def run_blocking(self, function, *args):
+        """
+        Runs a blocking function on the thread pool, keeping the coroutine's phase
+        """
+        context = contextvars.copy_context()
+        return self.loop.run_in_executor(
+            self.executor, functools.partial(context.run, function, *args)
+        )
+
+    def start_phase(self, desc, kind):
+        phase = DownloadPhase(desc, kind)
+        self.phases.append(phase)
+        return phase
+
+    def submit(self, phase, entry):
+        lane = self.lanes.reserve(entry)
+        phase.add()
+        with self.lanes_lock:
+            self.lanes.push(phase, entry)
+        try:
+            self.call(self.run_next())
+        except BaseException:
+            self.lanes.slots[lane].release()
+            phase.complete(failed=True)
+            raise
+
+    def pop(self):
+        with self.lanes_lock:
+            return self.lanes.pop()
+
+    async def run_next(self):
+        """
+        DownloadScheduler.run_next, waiting on the event loop instead of in a thread
+        """
+        async with self.ready:
+            lane, phase, entry = await self.ready.wait_for(self.pop)
+        try:
+            await self.run(phase, entry)
+        finally:
+            with self.lanes_lock:
+                self.lanes.release(lane)
+            async with self.ready:
+                self.ready.notify()
+
+    async def run(self, phase, entry):
+        result = None
+        CURRENT_PHASE.set(phase)
+        try:
+            start = perf_counter()
+            if not self.stopping.is_set():
+                result = await self.download_media_item(entry)
+                if result:
+                    self.metrics.observe(
+                        "download_seconds",
+                        perf_counter() - start,
+                        DOWNLOAD_BUCKETS,
+                        phase=phase.kind,
+                    )
+                    await self.run_blocking(self.on_result, *result)
+        except Exception as e:
+            print(" [ERROR] media item could not be saved because:", e)
+        finally:
+            # download_media_item returns False when the item was already downloaded
+            outcome = (
+                "downloaded" if result else "failed" if result is None else "skipped"
+            )
+            self.metrics.increment("items_total", phase=phase.kind, result=outcome)
+            phase.complete(downloaded=bool(result), failed=result is None)
+
+    async def retry(self, operation):
+        """
+        RetryPolicy.run for coroutines, using the account's download retry policy
+        """
+        policy = self.account.download_retry
+        if self.limit is None:
+            self.limit = AsyncConcurrency(policy.limiter)
+        for attempt in range(1, policy.attempts + 1):
+            try:
+                async with self.limit:
+                    result = await operation()
+            except Exception as e:
+                delay = policy.get_delay(e, attempt)
+                if delay is None:
+                    raise
+                await self.sleep(delay)
+            else:
+                policy.limiter.on_success()
+                return result
+
+    async def sleep(self, seconds):
+        # Ends early when the scheduler is stopping
+        end = perf_counter() + seconds
+        while not self.stopping.is_set() and perf_counter() < end:
+            await asyncio.sleep(min(0.5, end - perf_counter()))
+
+    async def download_media_item(self, entry):
+        """
+        PhotosAccount.download_media_item with the media streamed by aiohttp
+        """
+        account = self.account
+        try:
+            uuid, album_uuid, path, description = (
+                entry.uuid,
+                entry.album_uuid,
+                entry.path,
+                entry.description,
+            )
+            url, listed_at = entry.url, entry.listed_at
+            account.url_refresher.unregister(uuid)
+            if await self.run_blocking(os.path.isfile, path):
+                return False
+            await self.run_blocking(account.make_dir, os.path.dirname(path))
+
+            part_path = get_part_path(path, uuid)
+            try:
+                sha256 = await self.retry(
+                    lambda: self.stream_media_item(uuid, url, listed_at, part_path)
+                )
+                return await self.run_blocking(
+                    account.save_media_item,
+                    uuid,
+                    album_uuid,
+                    path,
+                    part_path,
+                    description,
+                    sha256,
+                    entry.created,
+                )
+            except BaseException:
+                await self.run_blocking(account.remove_part_file, uuid, part_path)
+                raise
+        except Exception as e:
+            if not self.stopping.is_set():
+                print(" [ERROR] media item could not be downloaded because:", e)
+            return None
+
+    async def stream_media_item(self, uuid, url, listed_at, part_path):
+        """
+        PhotosAccount.stream_media_item on the event loop
+        """
+        account = self.account
+        offset = await self.run_blocking(account.get_resume_offset, uuid, part_path)
+        if offset and offset == account.partials[uuid]:
+            return await self.run_blocking(hash_file, part_path)
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        phase = CURRENT_PHASE.get()
+
+        try:
+            url = await self.run_blocking(
+                account.url_refresher.get_url, uuid, url, listed_at
+            )
+            r = await self.session.get(url, headers=headers)
+            if r.status == 403:
+                r.release()
+                url = await self.run_blocking(
+                    account.url_refresher.get_url, uuid, url, listed_at, True
+                )
+                r = await self.session.get(url, headers=headers)
+
+            def raise_for_status():
+                # r.raise_for_status() would release the connection off the event loop
+                if r.status >= 400:
+                    raise aiohttp.ClientResponseError(
+                        r.request_info, r.history, status=r.status, message=r.reason
+                    )
+
+            async with r:
+                mode, sha256, expected_size = await self.run_blocking(
+                    account.start_part_file,
+                    uuid,
+                    part_path,
+                    offset,
+                    r.status,
+                    r.headers,
+                    raise_for_status,
+                )
+                part_file = await self.run_blocking(open, part_path, mode)
+                try:
+                    buffer = bytearray()
+                    async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        if self.stopping.is_set():
+                            raise InterruptedError("download cancelled")
+                        buffer += chunk
+                        self.metrics.increment("bytes_downloaded_total", len(chunk))
+                        phase.add_bytes(len(chunk))
+                        wait = account.bandwidth_limiter.reserve(len(chunk))
+                        if wait:
+                            await self.sleep(wait)
+                        # Written (and hashed) in chunks off the event loop
+                        if len(buffer) >= DOWNLOAD_CHUNK_SIZE:
+                            await self.run_blocking(
+                                self.write_chunk, part_file, sha256, bytes(buffer)
+                            )
+                            buffer.clear()
+                    await self.run_blocking(
+                        self.write_chunk, part_file, sha256, bytes(buffer), True
+                    )
+                finally:
+                    await self.run_blocking(part_file.close)
+                await self.run_blocking(
+                    account.check_part_size, part_path, expected_size
+                )
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+            # Retried like the connection errors of the thread engine
+            raise ConnectionError(str(e)) from e
+        except asyncio.TimeoutError as e:
+            raise TimeoutError("media server timed out") from e
+        return sha256
+
+    def write_chunk(self, part_file, sha256, chunk, last=False):
+        part_file.write(chunk)
+        sha256.update(chunk)
+        if last:
+            part_file.flush()
+            with self.metrics.timer("filesystem_seconds_total"):
+                os.fsync(part_file.fileno())
+
+    def join(self):
+        for phase in self.phases:
+            phase.done.wait()
+
+    async def close_session(self):
+        # Downloads see self.stopping and give up, entries that haven't started are cancelled
+        tasks = [
+            task for task in asyncio.all_tasks() if task is not asyncio.current_task()
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.session.close()
+
+    def shutdown(self):
+        """
+        Stops the scheduler, cancelling queued entries and interrupting running downloads
+        """
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        self.call(self.close_session()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,1008 @@
+"""
+Benchmarks
+Archiver for Google Photos
+By: Nick Dawson | nick@ndawson.me
+
+"""
+
+"""
+    Archiver For Google Photos
+    - A tool to maintain an archive/mirror of your Google Photos library for backup purposes.
+    Copyright (C) 2021  Nicholas Dawson
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+import argparse
+import gc
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep, time
+from urllib.parse import parse_qs, urlparse
+
+from gparch import (
+    DATABASE_NAME,
+    DEFAULT_PRIORITY,
+    ENGINES,
+    LIBRARY_LAYOUTS,
+    PRIORITIES,
+    PhotosAccount,
+    iter_entries,
+    parse_bandwidth_schedule,
+    parse_creation_time,
+    parse_qps_schedule,
+    sanitize,
+    write_description_lossless,
+    write_description_reencode,
+)
+
+
+def get_discovery_document(root_url):
+    """
+    Returns a minimal Photos Library API discovery document pointing at root_url,
+    covering only the methods the archiver uses
+    """
+    paging = {
+        "pageSize": {"type": "integer", "location": "query", "format": "int32"},
+        "pageToken": {"type": "string", "location": "query"},
+    }
+
+    def method(name, path, http_method="GET", parameters=None, request=None):
+        description = {
+            "id": "photoslibrary." + name,
+            "path": path,
+            "flatPath": path,
+            "httpMethod": http_method,
+            "parameters": parameters or {},
+            "parameterOrder": [],
+            "response": {"$ref": "Response"},
+        }
+        if request:
+            description["request"] = {"$ref": request}
+        return description
+
+    return {
+        "kind": "discovery#restDescription",
+        "discoveryVersion": "v1",
+        "id": "photoslibrary:v1",
+        "name": "photoslibrary",
+        "version": "v1",
+        "rootUrl": root_url,
+        "servicePath": "",
+        "baseUrl": root_url,
+        "batchPath": "batch",
+        "parameters": {},
+        "schemas": {
+            "SearchMediaItemsRequest": {
+                "id": "SearchMediaItemsRequest",
+                "type": "object",
+            },
+            "Response": {"id": "Response", "type": "object"},
+        },
+        "resources": {
+            "albums": {
+                "methods": {
+                    "list": method("albums.list", "v1/albums", parameters=paging)
+                }
+            },
+            "sharedAlbums": {
+                "methods": {
+                    "list": method(
+                        "sharedAlbums.list", "v1/sharedAlbums", parameters=paging
+                    )
+                }
+            },
+            "mediaItems": {
+                "methods": {
+                    "list": method(
+                        "mediaItems.list", "v1/mediaItems", parameters=paging
+                    ),
+                    "search": method(
+                        "mediaItems.search",
+                        "v1/mediaItems:search",
+                        "POST",
+                        request="SearchMediaItemsRequest",
+                    ),
+                    "batchGet": method(
+                        "mediaItems.batchGet",
+                        "v1/mediaItems:batchGet",
+                        parameters={
+                            "mediaItemIds": {
+                                "type": "string",
+                                "location": "query",
+                                "repeated": True,
+                            }
+                        },
+                    ),
+                }
+            },
+        },
+    }
+
+
+def make_jpeg_header():
+    """
+    Returns a tiny JPEG with camera-style EXIF data, fake images are this header padded to size
+    """
+    import piexif
+    from PIL import Image
+
+    output = io.BytesIO()
+    Image.new("RGB", (64, 48), "gray").save(
+        output,
+        format="JPEG",
+        exif=piexif.dump({"0th": {piexif.ImageIFD.Make: b"Benchmark"}}),
+    )
+    return output.getvalue()
+
+
+class FakeLibrary(object):
+    """
+    Generated Google Photos library served by FakePhotosServer
+    - every media item gets unique content derived from its id, images are valid JPEGs
+    - ids in archived are left out of filtered searches unless they include archived media
+    """
+
+    def __init__(
+        self,
+        count,
+        albums,
+        shared_albums,
+        album_size,
+        favorite_ratio,
+        description_ratio,
+        video_ratio,
+        image_size,
+        video_size,
+        seed=0,
+    ):
+        rng = random.Random(seed)
+        self.jpeg_header = make_jpeg_header()
+        self.items = []
+        self.favorites = []
+        self.sizes = {}
+        self.archived = set()
+        for i in range(count):
+            is_video = rng.random() < video_ratio
+            item = {
+                "id": f"FAKE{i:08}" + hashlib.sha1(str(i).encode()).hexdigest() * 2,
+                "filename": f"{'VID' if is_video else 'IMG'}_{i % 9999:04}.{'MP4' if is_video else 'JPG'}",
+                "mimeType": "video/mp4" if is_video else "image/jpeg",
+                "mediaMetadata": {
+                    "creationTime": f"20{10 + i % 12}-{1 + i % 12:02}-{1 + i % 28:02}T12:00:00Z",
+                    "width": "1920" if is_video else "4032",
+                    "height": "1080" if is_video else "3024",
+                },
+            }
+            if rng.random() < description_ratio:
+                item["description"] = f"Description of item {i}"
+            # Sizes vary +-50% around the configured average
+            average = video_size if is_video else image_size
+            self.sizes[item["id"]] = max(
+                len(self.jpeg_header), int(average * rng.uniform(0.5, 1.5))
+            )
+            self.items.append(item)
+            if rng.random() < favorite_ratio:
+                self.favorites.append(item)
+
+        self.items_by_id = {item["id"]: item for item in self.items}
+        self.albums = []
+        self.shared_albums = []
+        self.album_items = {}
+        for i in range(albums + shared_albums):
+            album = {
+                "id": f"ALBUM{i:06}",
+                "title": f"Album {i}",
+                "mediaItemsCount": str(album_size),
+            }
+            self.album_items[album["id"]] = rng.sample(
+                self.items, min(album_size, len(self.items))
+            )
+            (self.albums if i < albums else self.shared_albums).append(album)
+
+    def filter_dates(self, ranges):
+        """
+        Returns the items created within any of the (inclusive) mediaItems.search date ranges
+        """
+        bounds = [
+            tuple(
+                f"{date['year']:04}-{date['month']:02}-{date['day']:02}"
+                for date in (date_range["startDate"], date_range["endDate"])
+            )
+            for date_range in ranges
+        ]
+        return [
+            item
+            for item in self.items
+            if any(
+                start <= item["mediaMetadata"]["creationTime"][:10] <= end
+                for start, end in bounds
+            )
+        ]
+
+    def get_content(self, uuid, start, end):
+        """
+        Returns bytes start..end (exclusive) of the media item's content
+        """
+        item = self.items_by_id[uuid]
+        header = self.jpeg_header if "image" in item["mimeType"] else b""
+        block = hashlib.sha256(uuid.encode()).digest() * 2048  # 64 KiB
+        content = bytearray()
+        position = start
+        while position < end:
+            if position < len(header):
+                chunk = header[position : min(end, len(header))]
+            else:
+                offset = (position - len(header)) % len(block)
+                chunk = block[
+                    offset : offset + min(end - position, len(block) - offset)
+                ]
+            content += chunk
+            position += len(chunk)
+        return bytes(content)
+
+
+class FakePhotosServer(object):
+    """
+    Local stand-in for the Photos Library API and its media server
+    - latency is added to every request, error_rate of requests fail with a 503
+    - media downloads honour Range requests
+    """
+
+    def __init__(self, library, latency=0.0, error_rate=0.0, page_size_cap=100):
+        self.library = library
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_size_cap = page_size_cap
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        self.api_requests = 0
+        self.media_requests = 0
+        self.errors = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self, "GET")
+
+            def do_POST(self):
+                server.handle(self, "POST")
+
+            def do_HEAD(self):
+                server.handle(self, "HEAD")
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.root_url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @staticmethod
+    def send_json(handler, body, status=200):
+        content = json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def paginate(self, items, key, page_size, page_token):
+        start = int(page_token or 0)
+        end = start + min(int(page_size or 25), self.page_size_cap)
+        page = {key: items[start:end]} if items[start:end] else {}
+        if end < len(items):
+            page["nextPageToken"] = str(end)
+        return page
+
+    def with_base_url(self, item):
+        return dict(item, baseUrl=self.root_url + "media/" + item["id"])
+
+    def handle(self, handler, http_method):
+        url = urlparse(handler.path)
+        query = parse_qs(url.query)
+        body = {}
+        if http_method == "POST":
+            length = int(handler.headers.get("Content-Length", 0))
+            content = handler.rfile.read(length)
+            if handler.headers.get("X-HTTP-Method-Override") == "GET":
+                # googleapiclient sends GETs with very long urls (batchGet) this way
+                http_method = "GET"
+                query = parse_qs(content.decode())
+            else:
+                body = json.loads(content or b"{}")
+
+        if self.latency:
+            sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            with self.lock:
+                self.errors += 1
+            handler.send_response(503)
+            handler.send_header("Retry-After", "0")
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+
+        if url.path.startswith("/media/"):
+            return self.send_media(handler, url.path[len("/media/") :])
+
+        with self.lock:
+            self.api_requests += 1
+        page_size = query.get("pageSize", [body.get("pageSize")])[0]
+        page_token = query.get("pageToken", [body.get("pageToken")])[0]
+        library = self.library
+        if url.path == "/v1/albums":
+            page = self.paginate(library.albums, "albums", page_size, page_token)
+        elif url.path == "/v1/sharedAlbums":
+            page = self.paginate(
+                library.shared_albums, "sharedAlbums", page_size, page_token
+            )
+        elif url.path == "/v1/mediaItems":
+            page = self.paginate(library.items, "mediaItems", page_size, page_token)
+        elif url.path == "/v1/mediaItems:search":
+            filters = body.get("filters", {})
+            if "albumId" in body:
+                items = library.album_items.get(body["albumId"], [])
+            elif "dateFilter" in filters:
+                items = library.filter_dates(filters["dateFilter"]["ranges"])
+            else:
+                items = library.favorites
+            if "filters" in body and not body.get("includeArchivedMedia"):
+                items = [item for item in items if item["id"] not in library.archived]
+            page = self.paginate(items, "mediaItems", page_size, page_token)
+        elif url.path == "/v1/mediaItems:batchGet":
+            page = {
+                "mediaItemResults": [
+                    {"mediaItem": self.with_base_url(library.items_by_id[uuid])}
+                    for uuid in query.get("mediaItemIds", [])
+                    if uuid in library.items_by_id
+                ]
+            }
+        else:
+            return self.send_json(handler, {"error": "not found"}, 404)
+
+        if "mediaItems" in page:
+            page["mediaItems"] = [
+                self.with_base_url(item) for item in page["mediaItems"]
+            ]
+        self.send_json(handler, page)
+
+    def send_media(self, handler, name):
+        uuid = name.rsplit("=", 1)[0]
+        if uuid not in self.library.sizes:
+            handler.send_response(404)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+
+        size = self.library.sizes[uuid]
+        start, end = 0, size
+        byte_range = handler.headers.get("Range")
+        if byte_range:
+            start = int(byte_range.split("=", 1)[1].split("-", 1)[0])
+            handler.send_response(206)
+            handler.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        else:
+            handler.send_response(200)
+        handler.send_header("Content-Length", str(end - start))
+        handler.end_headers()
+        if handler.command == "HEAD":
+            return
+
+        with self.lock:
+            self.media_requests += 1
+        position = start
+        while position < end:
+            chunk = self.library.get_content(uuid, position, min(end, position + 65536))
+            handler.wfile.write(chunk)
+            position += len(chunk)
+        with self.lock:
+            self.bytes_sent += end - start
+
+
+def get_fake_service(root_url):
+    """
+    Builds a googleapiclient service for the fake API (no credentials needed)
+    """
+    import httplib2
+    from googleapiclient.discovery import build_from_document
+
+    return build_from_document(get_discovery_document(root_url), http=httplib2.Http())
+
+
+def run_sync(account, incremental=False):
+    """
+    Runs every download phase in the same order as gparch_cli and returns
+    {phase: seconds until its listing finished}
+    - incremental lists the library with the date window of gparch_cli --incremental
+    """
+    listing = {}
+    start = perf_counter()
+    for name, phase in (
+        ("favorites", account.download_favorites),
+        ("albums", account.download_all_albums),
+        ("shared", account.download_all_shared_albums),
+        ("library", lambda: account.download_library(incremental)),
+    ):
+        phase()
+        listing[name] = perf_counter() - start
+    account.wait_for_downloads()
+    return listing
+
+
+def make_sample_jpegs(directory, count, width, height):
+    """
+    Writes count noisy JPEG images with camera-style EXIF data to directory and returns their paths
+    - noise is used so the images compress like real photos rather than flat colour
+    """
+    import piexif
+    from PIL import Image
+
+    exif_bytes = piexif.dump(
+        {
+            "0th": {piexif.ImageIFD.Make: b"Benchmark", piexif.ImageIFD.Model: b"Cam"},
+            "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2021:01:01 12:00:00"},
+        }
+    )
+
+    paths = []
+    for i in range(count):
+        img = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+        path = os.path.join(directory, f"IMG_{i:04}.JPG")
+        img.save(path, quality=90, exif=exif_bytes)
+        paths.append(path)
+    return paths
+
+
+def time_description_writer(writer, sources, directory, description):
+    """
+    Copies every source image into directory and times writer over the copies
+    Returns (seconds, total bytes written)
+    """
+    os.makedirs(directory)
+    copies = []
+    for source in sources:
+        copy = os.path.join(directory, os.path.basename(source))
+        shutil.copyfile(source, copy)
+        copies.append(copy)
+
+    start = perf_counter()
+    for copy in copies:
+        writer(copy, description)
+    seconds = perf_counter() - start
+
+    return seconds, sum(os.path.getsize(copy) for copy in copies)
+
+
+def bench_exif(args):
+    width, height = (int(n) for n in args.size.split("x"))
+    description = "".join(random.choice("abcdefghij ") for _ in range(200))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"Generating {args.count} {width}x{height} JPEGs...")
+        sources = make_sample_jpegs(tmp, args.count, width, height)
+        source_bytes = sum(os.path.getsize(source) for source in sources)
+
+        results = [
+            (
+                "lossless (piexif.insert)",
+                time_description_writer(
+                    write_description_lossless, sources, tmp + "/lossless", description
+                ),
+            ),
+            (
+                "re-encode (Pillow)",
+                time_description_writer(
+                    write_description_reencode, sources, tmp + "/reencode", description
+                ),
+            ),
+        ]
+
+    print(f"Source images: {source_bytes / 1024 ** 2:.1f} MB")
+    for name, (seconds, written) in results:
+        print(
+            f"{name:>26}: {seconds:.2f}s total, "
+            f"{seconds / args.count * 1000:.1f} ms/image, "
+            f"{written / 1024 ** 2:.1f} MB on disk"
+        )
+
+
+def report_sync(label, account, server, seconds, listing, bytes_before):
+    transferred = server.bytes_sent - bytes_before
+    _, downloads = account.get_session_stats()
+    download_retries, download_throttles, api_retries, _ = account.get_retry_stats()
+    _, connections, reused = account.get_transport_stats()
+
+    # Download time per phase: first item started -> last item finished
+    phase_seconds = {}
+    for phase in account.scheduler.phases:
+        first, last = phase_seconds.get(phase.kind, (phase.started, 0))
+        phase_seconds[phase.kind] = (
+            min(first, phase.started),
+            max(last, phase.started + phase.seconds),
+        )
+
+    print(f"--- {label} ---")
+    print(
+        f"  {downloads} items in {seconds:.2f}s: {downloads / seconds:.1f} items/s, "
+        f"{transferred / 1024 ** 2 / seconds:.1f} MB/s ({transferred / 1024 ** 2:.1f} MB)"
+    )
+    print(
+        "  listing done at: "
+        + ", ".join(f"{name} {end:.2f}s" for name, end in listing.items())
+    )
+    print(
+        "  phase download time: "
+        + ", ".join(
+            f"{kind} {last - first:.2f}s"
+            for kind, (first, last) in phase_seconds.items()
+        )
+    )
+    print(
+        f"  sqlite: {account.writer.seconds:.3f}s, "
+        f"retries: {download_retries} downloads / {api_retries} API "
+        f"({download_throttles} throttled), "
+        f"connections: {connections} opened / {reused} reused"
+    )
+    _, api_per_second, bandwidth_waited, api_waited = account.get_rate_stats()
+    print(
+        f"  API: {api_per_second:.1f} requests/s, rate limit waits: "
+        f"{bandwidth_waited:.1f}s bandwidth / {api_waited:.1f}s API"
+    )
+    lanes = account.lanes
+    print(
+        "  lanes: "
+        + ", ".join(
+            f"{lane} {lanes.completed[lane]} done at "
+            f"{lanes.finished_at[lane] - account.timer:.2f}s"
+            for lane in lanes.completed
+            if lanes.finished_at[lane]
+        )
+    )
+    metrics = account.metrics
+    api_pages = metrics.to_dict()["metrics"].get("api_page_seconds", {"values": []})
+    print(
+        f"  filesystem: {metrics.get('filesystem_seconds_total'):.3f}s, "
+        "API pages: "
+        + ", ".join(
+            f"{page['labels']['method']} {page['count']} in {page['sum']:.2f}s"
+            for page in api_pages["values"]
+        )
+    )
+
+
+def bench_sync(args):
+    library = FakeLibrary(
+        args.count,
+        args.albums,
+        args.shared_albums,
+        args.album_size,
+        args.favorite_ratio,
+        args.description_ratio,
+        args.video_ratio,
+        args.image_kb * 1024,
+        args.video_kb * 1024,
+    )
+    print(
+        f"Fake library: {args.count} items, {args.albums} albums, "
+        f"{args.shared_albums} shared albums, "
+        f"{sum(library.sizes.values()) / 1024 ** 2:.1f} MB"
+    )
+
+    with FakePhotosServer(library, args.latency_ms / 1000, args.error_rate) as server:
+        for engine, thread_count in itertools.product(args.engine, args.threads):
+            with tempfile.TemporaryDirectory() as tmp:
+                runs = ["initial sync"] + ["incremental sync"] * args.incremental
+                for label in runs:
+                    account = PhotosAccount(
+                        None,
+                        tmp,
+                        thread_count,
+                        False,
+                        api_concurrency=args.api_concurrency,
+                        bandwidth_schedule=args.max_bandwidth,
+                        api_qps_schedule=args.max_api_qps,
+                        engine=engine,
+                        video_threads=args.video_threads,
+                        priority=args.priority,
+                        library_layout=args.library_layout,
+                    )
+                    account.service = get_fake_service(server.root_url)
+                    bytes_before = server.bytes_sent
+                    start = perf_counter()
+                    try:
+                        listing = run_sync(
+                            account, args.date_window and label != "initial sync"
+                        )
+                        report_sync(
+                            f"{label}, {engine} engine, {thread_count} "
+                            + (
+                                "threads"
+                                if engine == "thread"
+                                else "concurrent downloads"
+                            ),
+                            account,
+                            server,
+                            perf_counter() - start,
+                            listing,
+                            bytes_before,
+                        )
+                        if args.metrics_json:
+                            account.write_metrics(json_path=args.metrics_json)
+                    finally:
+                        account.close()
+                if args.reindex:
+                    bench_reindex(server, tmp, thread_count)
+
+
+def bench_reindex(server, directory, thread_count):
+    """
+    Deletes the database of a synced archive, rebuilds it with reindex_archive and compares
+    the rebuilt media table with the original one
+    """
+    db_path = os.path.join(directory, DATABASE_NAME)
+    with sqlite3.connect(db_path) as con:
+        synced = {
+            row[0]: row[1:]
+            for row in con.execute("SELECT uuid, path, album_uuid FROM media")
+        }
+    con.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+    account = PhotosAccount(None, directory, thread_count, False)
+    account.service = get_fake_service(server.root_url)
+    requests_before = server.api_requests + server.media_requests
+    start = perf_counter()
+    try:
+        counts = account.reindex_archive()
+    finally:
+        account.close()
+    seconds = perf_counter() - start
+    requests_made = server.api_requests + server.media_requests - requests_before
+    with sqlite3.connect(db_path) as con:
+        rebuilt = {
+            row[0]: row[1:]
+            for row in con.execute("SELECT uuid, path, album_uuid FROM media")
+        }
+    con.close()
+    identical = sum(rebuilt.get(uuid) == row for uuid, row in synced.items())
+    print(
+        f"--- reindex ---\n"
+        f"  {counts['matched']} files matched in {seconds:.2f}s "
+        f"({counts['matched'] / seconds:.0f} files/s), {counts['albums']} albums, "
+        f"{counts['unmatched']} unmatched, {requests_made} requests\n"
+        f"  {identical} of {len(synced)} media rows identical to the synced database"
+    )
+
+
+def make_api_page(start, count):
+    """
+    Returns a JSON mediaItems page shaped like the real API's, with its long ids and baseUrls
+    """
+    items = []
+    for i in range(start, start + count):
+        digest = hashlib.sha256(str(i).encode()).hexdigest()
+        uuid = "A" + (digest * 2)[:97]
+        items.append(
+            {
+                "id": uuid,
+                "productUrl": "https://photos.google.com/lr/photo/" + uuid,
+                "baseUrl": "https://lh3.googleusercontent.com/lr/" + digest * 5,
+                "mimeType": "image/jpeg",
+                "mediaMetadata": {
+                    "creationTime": "2021-06-01T12:00:00Z",
+                    "width": "4032",
+                    "height": "3024",
+                    "photo": {
+                        "cameraMake": "Google",
+                        "cameraModel": "Pixel 5",
+                        "focalLength": 4.38,
+                        "apertureFNumber": 1.73,
+                        "isoEquivalent": 61,
+                        "exposureTime": "0.004s",
+                    },
+                },
+                "filename": f"PXL_20210601_{i:09}.jpg",
+            }
+        )
+    return json.dumps({"mediaItems": items})
+
+
+def measure_listing(count, keep):
+    """
+    Lists count items one JSON page at a time and returns the bytes still allocated
+    for what keep (called with each decoded page) returned
+    """
+    kept = []
+    gc.collect()
+    tracemalloc.start()
+    for start in range(0, count, 100):
+        page = json.loads(make_api_page(start, min(100, count - start)))
+        kept.extend(keep(page["mediaItems"]))
+        del page
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return allocated
+
+
+def keep_entries(items, directory):
+    """
+    Yields the MediaEntry each listed item is queued as, with its path in directory
+    """
+    for entry in iter_entries(items):
+        entry.directory = directory
+        entry.filename = sanitize(entry.filename)
+        yield entry
+
+
+def bench_memory(args):
+    directory = os.path.join(tempfile.gettempdir(), "Photos Archive", "Library")
+
+    def keep_tuples(items):
+        # Entries as the 6-tuples queued before MediaEntry, url and path built up front
+        for item in items:
+            yield (
+                item["id"],
+                None,
+                item["baseUrl"] + "=d",
+                directory + "/" + sanitize(item["filename"]),
+                item.get("description"),
+                time(),
+            )
+
+    def keep_priority_tuples(items):
+        # The same tuples with what MediaEntry also keeps for priorities and the date layout
+        for item in items:
+            metadata = item["mediaMetadata"]
+            yield (
+                item["id"],
+                None,
+                item["baseUrl"] + "=d",
+                directory + "/" + sanitize(item["filename"]),
+                item.get("description"),
+                time(),
+                parse_creation_time(metadata["creationTime"]),
+                int(metadata["width"]) * int(metadata["height"]),
+            )
+
+    print(f"Memory held per 100k listed media items ({args.count} items measured):")
+    for name, keep in (
+        ("API dicts", list),
+        ("6-tuples", keep_tuples),
+        ("8-tuples", keep_priority_tuples),
+        ("MediaEntry", lambda items: keep_entries(items, directory)),
+    ):
+        allocated = measure_listing(args.count, keep)
+        print(f"{name:>26}: {allocated / args.count * 100000 / 1024 ** 2:.1f} MB")
+
+    # Peak of a whole library listing held in a --plan, where every entry is kept
+    library = FakeLibrary(args.count, 0, 0, 0, 0, 0.05, 0.05, 1024, 1024)
+    with FakePhotosServer(library) as server, tempfile.TemporaryDirectory() as tmp:
+        account = PhotosAccount(None, tmp, 1, False)
+        account.service = get_fake_service(server.root_url)
+        try:
+            account.start_plan()
+            gc.collect()
+            tracemalloc.start()
+            account.download_library()
+            allocated, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            account.close()
+    print(
+        f"{'--plan library listing':>26}: "
+        f"{allocated / args.count * 100000 / 1024 ** 2:.1f} MB held, "
+        f"{peak / args.count * 100000 / 1024 ** 2:.1f} MB peak"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks for Archiver for Google Photos."
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    exif_parser = subparsers.add_parser(
+        "exif",
+        help="compare the lossless and re-encoding EXIF description writers",
+    )
+    exif_parser.add_argument(
+        "-n",
+        "--count",
+        help="number of described images to process (default: 50)",
+        default=50,
+        type=int,
+    )
+    exif_parser.add_argument(
+        "--size",
+        help="dimensions of the generated images as WIDTHxHEIGHT (default: 4032x3024)",
+        default="4032x3024",
+        type=str,
+    )
+    exif_parser.set_defaults(func=bench_exif)
+
+    sync_parser = subparsers.add_parser(
+        "sync",
+        help="run PhotosAccount end to end against a local fake Photos API and media server",
+    )
+    sync_parser.add_argument(
+        "-n",
+        "--count",
+        help="media items in the library (default: 2000)",
+        default=2000,
+        type=int,
+    )
+    sync_parser.add_argument(
+        "--albums", help="albums in the library (default: 20)", default=20, type=int
+    )
+    sync_parser.add_argument(
+        "--shared-albums", help="shared albums (default: 5)", default=5, type=int
+    )
+    sync_parser.add_argument(
+        "--album-size", help="media items per album (default: 30)", default=30, type=int
+    )
+    sync_parser.add_argument(
+        "--favorite-ratio",
+        help="fraction of items marked as favorite (default: 0.05)",
+        default=0.05,
+        type=float,
+    )
+    sync_parser.add_argument(
+        "--description-ratio",
+        help="fraction of items with a description (default: 0.05)",
+        default=0.05,
+        type=float,
+    )
+    sync_parser.add_argument(
+        "--video-ratio",
+        help="fraction of items that are videos (default: 0.05)",
+        default=0.05,
+        type=float,
+    )
+    sync_parser.add_argument(
+        "--image-kb",
+        help="average image size in KB (default: 300)",
+        default=300,
+        type=int,
+    )
+    sync_parser.add_argument(
+        "--video-kb",
+        help="average video size in KB (default: 5000)",
+        default=5000,
+        type=int,
+    )
+    sync_parser.add_argument(
+        "--latency-ms",
+        help="latency added to every request in milliseconds (default: 5)",
+        default=5,
+        type=float,
+    )
+    sync_parser.add_argument(
+        "--error-rate",
+        help="fraction of requests answered with a 503 (default: 0)",
+        default=0.0,
+        type=float,
+    )
+    sync_parser.add_argument(
+        "-t",
+        "--threads",
+        help="download thread counts to compare (default: 8)",
+        default=[8],
+        nargs="+",
+        type=int,
+    )
+    sync_parser.add_argument(
+        "--engine",
+        help="download engines to compare, each is run with every --threads value "
+        "(default: thread)",
+        default=["thread"],
+        nargs="+",
+        choices=ENGINES,
+    )
+    sync_parser.add_argument(
+        "--video-threads",
+        help="most videos downloaded at once (default: half of --threads)",
+        type=int,
+    )
+    sync_parser.add_argument(
+        "--priority",
+        help=f"order queued downloads start in (default: {DEFAULT_PRIORITY})",
+        default=DEFAULT_PRIORITY,
+        choices=PRIORITIES,
+    )
+    sync_parser.add_argument(
+        "--library-layout",
+        help="Library folder layout, as gparch_cli --library-layout (default: flat)",
+        choices=LIBRARY_LAYOUTS,
+    )
+    sync_parser.add_argument(
+        "--api-concurrency",
+        help="albums listed in parallel (default: 1)",
+        default=1,
+        type=int,
+    )
+    sync_parser.add_argument(
+        "--incremental",
+        help="amount of no-op incremental syncs to run after the initial sync (default: 1)",
+        default=1,
+        type=int,
+    )
+    sync_parser.add_argument(
+        "--max-bandwidth",
+        help="download rate limit schedule, as gparch_cli --max-bandwidth",
+        type=parse_bandwidth_schedule,
+    )
+    sync_parser.add_argument(
+        "--max-api-qps",
+        help="API rate limit schedule, as gparch_cli --max-api-qps",
+        type=parse_qps_schedule,
+    )
+    sync_parser.add_argument(
+        "--date-window",
+        help="list the library of the incremental syncs by creation date since the last sync",
+        action="store_true",
+    )
+    sync_parser.add_argument(
+        "--reindex",
+        help="after the syncs, delete the database and time rebuilding it from the archive",
+        action="store_true",
+    )
+    sync_parser.add_argument(
+        "--metrics-json",
+        help="write the run metrics of the last sync to this JSON file",
+        type=str,
+    )
+    sync_parser.set_defaults(func=bench_sync)
+
+    memory_parser = subparsers.add_parser(
+        "memory",
+        help="measure the memory listed media items take as API dicts, tuples and MediaEntry",
+    )
+    memory_parser.add_argument(
+        "-n",
+        "--count",
+        help="media items to list (default: 100000)",
+        default=100000,
+        type=int,
+    )
+    memory_parser.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    args.func(args)
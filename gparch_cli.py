@@ -25,18 +25,50 @@ By: Nick Dawson | nick@ndawson.me
 
 """
 
+from time import perf_counter
+
+STARTUP_TIMER = perf_counter()  # Started before anything else is imported
+
 import argparse
+from multiprocessing import freeze_support
 from os import getcwd
 
 from colorama import Fore, init
 
-from gparch import VERSION, PhotosAccount
+from gparch import (
+    DEFAULT_API_CONCURRENCY,
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_ENGINE,
+    DEFAULT_FULL_SYNC_DAYS,
+    DEFAULT_LINK_MODE,
+    DEFAULT_METRICS_INTERVAL,
+    DEFAULT_OVERLAP_DAYS,
+    DEFAULT_PRIORITY,
+    DEFAULT_READ_TIMEOUT,
+    ENGINES,
+    LIBRARY_LAYOUTS,
+    LINK_MODES,
+    PRIORITIES,
+    VERSION,
+    PhotosAccount,
+    SyncPlan,
+    parse_bandwidth_schedule,
+    parse_qps_schedule,
+)
 
 if __name__ == "__main__":
+    freeze_support()  # verify hashes in a process pool, needed by frozen builds
     init()  # Init colorama
 
     CWD = getcwd()
     DEFAULT_THREADS = 8
+    PLAN_KIND_NAMES = {
+        "favorites": "Favorites",
+        "album": "Albums",
+        "shared_album": "Shared Albums",
+        "library": "Library",
+        "repair": "Queued By Verify",
+    }
 
     parser = argparse.ArgumentParser(
         description="If no directory arg is provided the program will default to the current working directory. "
@@ -68,6 +100,163 @@ if __name__ == "__main__":
         default=DEFAULT_THREADS,
         type=int,
     )
+    parser.add_argument(
+        "--engine",
+        help="download engine: a pool of --threads threads, or async (needs aiohttp) with "
+        f"--threads concurrent downloads on one event loop, e.g. -t 200 (default: {DEFAULT_ENGINE})",
+        default=DEFAULT_ENGINE,
+        choices=ENGINES,
+    )
+    parser.add_argument(
+        "--image-threads",
+        help="most images downloaded at once, out of --threads (default: --threads)",
+        type=int,
+    )
+    parser.add_argument(
+        "--video-threads",
+        help="most videos downloaded at once, out of --threads, so large videos can't hold "
+        "up every download (default: half of --threads)",
+        type=int,
+    )
+    parser.add_argument(
+        "--priority",
+        help="order queued downloads start in: listing order, smallest (by dimensions, "
+        "images before videos), oldest or newest (by creation time) first "
+        f"(default: {DEFAULT_PRIORITY})",
+        default=DEFAULT_PRIORITY,
+        choices=PRIORITIES,
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        help=f"seconds to wait when opening a connection to the media server (default: {DEFAULT_CONNECT_TIMEOUT})",
+        default=DEFAULT_CONNECT_TIMEOUT,
+        type=float,
+    )
+    parser.add_argument(
+        "--read-timeout",
+        help=f"seconds to wait for data from the media server before giving up (default: {DEFAULT_READ_TIMEOUT})",
+        default=DEFAULT_READ_TIMEOUT,
+        type=float,
+    )
+    parser.add_argument(
+        "--api-concurrency",
+        help="amount of albums to list from the Google Photos API in parallel, "
+        f"separate from --threads (default: {DEFAULT_API_CONCURRENCY})",
+        default=DEFAULT_API_CONCURRENCY,
+        type=int,
+    )
+    parser.add_argument(
+        "--link-duplicates",
+        help="store media with identical content only once by linking the copies together "
+        f"(default: {DEFAULT_LINK_MODE})",
+        default=DEFAULT_LINK_MODE,
+        choices=LINK_MODES,
+    )
+    parser.add_argument(
+        "--dedupe",
+        help="link identical files that are already in the archive together and exit (no downloads), "
+        "with --link-duplicates off they are only counted",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--library-layout",
+        help="how Library is split into folders for new downloads: flat, date (YEAR/MONTH "
+        "folders) or hash (256 folders of even size), remembered by the archive "
+        "(default: the archive's layout, flat for new archives)",
+        choices=LIBRARY_LAYOUTS,
+    )
+    parser.add_argument(
+        "--migrate-layout",
+        help="move the files already in Library into this layout, update the database and exit "
+        "(date needs your Google account for media downloaded by older versions)",
+        choices=LIBRARY_LAYOUTS,
+    )
+    parser.add_argument(
+        "--reindex",
+        help="rebuild the database from the files already in the archive (e.g. after it was "
+        "lost or the archive was copied without it) and exit, nothing is downloaded again",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verify",
+        help="check that every archived file still exists and is intact and exit (no downloads), "
+        "missing or corrupt files are downloaded again by the next sync",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verify-hashes",
+        help="with --verify, also compare the content hash of files that changed since they were last verified",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verify-all",
+        help="with --verify, also check files that haven't changed since they were last verified",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--plan",
+        help="dry run: list everything and print what would be downloaded and its estimated size "
+        "without downloading anything, optionally saving the plan to PLAN_FILE for --replay",
+        nargs="?",
+        const="",
+        metavar="PLAN_FILE",
+    )
+    parser.add_argument(
+        "--replay",
+        help="download everything in a plan file saved by --plan without listing your library again",
+        metavar="PLAN_FILE",
+    )
+    parser.add_argument(
+        "--max-bandwidth",
+        help="limit download speed in bytes/s shared by all threads, e.g. 5M, "
+        "optionally by local time of day, e.g. 08:00-18:00=2M,unlimited (default: unlimited)",
+        type=parse_bandwidth_schedule,
+    )
+    parser.add_argument(
+        "--max-api-qps",
+        help="limit Google Photos API requests per second, with the same schedule format "
+        "as --max-bandwidth, e.g. 08:00-18:00=1,10 (default: unlimited)",
+        type=parse_qps_schedule,
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        help="only list library media created since the last successful library sync "
+        "(albums and favorites are always listed in full)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--overlap-days",
+        help="days before the last sync that an incremental sync lists again, to catch media "
+        f"uploaded after it was created (default: {DEFAULT_OVERLAP_DAYS})",
+        default=DEFAULT_OVERLAP_DAYS,
+        type=float,
+    )
+    parser.add_argument(
+        "--full-sync-days",
+        help="with --incremental, list the entire library again when the last full sync is "
+        f"older than this many days, 0 to never (default: {DEFAULT_FULL_SYNC_DAYS})",
+        default=DEFAULT_FULL_SYNC_DAYS,
+        type=float,
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="write run metrics (counters, timings and latency histograms) to this JSON file",
+        type=str,
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        help="write run metrics to this file in the Prometheus text format "
+        "(e.g. for node_exporter's textfile collector)",
+        type=str,
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        help="seconds between metrics file updates while running, 0 to only write them at the end "
+        f"(default: {DEFAULT_METRICS_INTERVAL})",
+        default=DEFAULT_METRICS_INTERVAL,
+        type=float,
+    )
 
     parser.add_argument(
         "-a",
@@ -109,9 +298,27 @@ if __name__ == "__main__":
         args.credentials = args.directory + "/credentials.json"
 
     # Init PhotosAccount object
-    account = PhotosAccount(args.credentials, args.directory, args.threads, args.debug)
-
-    account.get_google_api_service()
+    account = PhotosAccount(
+        args.credentials,
+        args.directory,
+        args.threads,
+        args.debug,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        api_concurrency=args.api_concurrency,
+        link_mode=args.link_duplicates,
+        bandwidth_schedule=args.max_bandwidth,
+        api_qps_schedule=args.max_api_qps,
+        engine=args.engine,
+        image_threads=args.image_threads,
+        video_threads=args.video_threads,
+        priority=args.priority,
+        library_layout=args.library_layout,
+    )
+    if (args.metrics_json or args.metrics_prom) and args.metrics_interval > 0:
+        account.start_metrics_writer(
+            args.metrics_interval, args.metrics_json, args.metrics_prom
+        )
 
     # ==============
     # ARG PROCESSING
@@ -130,36 +337,194 @@ if __name__ == "__main__":
         download_everything = True
 
     # Download everything
+    # - each phase only waits for its listing, the downloads themselves are
+    #   queued on one scheduler shared by every phase
+    startup_seconds = None
     try:
-        if args.favorites:
-            print(Fore.YELLOW + "Reading Favorites List From Server..." + Fore.BLUE)
-            account.download_favorites()
-            print(Fore.GREEN + "✔ Finished Downloading Favorites.")
-
-        if args.albums:
-            print(Fore.YELLOW + "Reading Albums List From Server..." + Fore.BLUE)
-            account.download_all_albums()
-            print(Fore.GREEN + "✔ Finished Downloading Albums.")
-
-        if args.shared:
-            print(Fore.YELLOW + "Reading Shared Albums List From Server..." + Fore.BLUE)
-            account.download_all_shared_albums()
-            print(Fore.GREEN + "✔ Finished Downloading Shared Albums.")
-
-        if download_everything:
-            print(Fore.YELLOW + "Reading Entire Library From Server..." + Fore.BLUE)
-            account.download_library()
-            print(Fore.GREEN + "✔ Finished Downloading Everything.")
+        if args.dedupe:
+            startup_seconds = perf_counter() - STARTUP_TIMER
+            print(Fore.YELLOW + "Deduplicating Archive..." + Fore.BLUE)
+            counts = account.dedupe_archive()
+            print(Fore.GREEN + "✔ Finished Deduplicating Archive.")
+            print(
+                Fore.BLUE
+                + f"Duplicates: {Fore.YELLOW}{counts['duplicates']} identical copies "
+                f"({counts['bytes'] / 1024 ** 2:.1f} MB)"
+                + (
+                    " left as they are (--link-duplicates off)"
+                    if args.link_duplicates == "off"
+                    else ""
+                )
+            )
+        elif args.migrate_layout:
+            startup_seconds = perf_counter() - STARTUP_TIMER
+            print(Fore.YELLOW + "Moving Library..." + Fore.BLUE)
+            moved, missing = account.migrate_library_layout(args.migrate_layout)
+            print(Fore.GREEN + "✔ Finished Moving Library.")
+            print(
+                Fore.BLUE
+                + f"Moved: {Fore.YELLOW}{moved} files into the {args.migrate_layout} layout, "
+                f"{missing} missing (run --verify to download them again)"
+            )
+        elif args.reindex:
+            account.get_google_api_service()
+            startup_seconds = perf_counter() - STARTUP_TIMER
+            print(Fore.YELLOW + "Reindexing Archive..." + Fore.BLUE)
+            counts = account.reindex_archive()
+            print(Fore.GREEN + "✔ Finished Reindexing Archive.")
+            print(
+                Fore.BLUE
+                + f"Reindexed: {Fore.YELLOW}{counts['matched']} files matched to your "
+                f"Google Photos, {counts['albums']} albums"
+            )
+            print(
+                Fore.BLUE
+                + f"Unmatched: {Fore.YELLOW}{counts['unmatched']} files that aren't in your "
+                "Google Photos anymore (left untouched)"
+            )
+        elif args.verify:
+            startup_seconds = perf_counter() - STARTUP_TIMER
+            print(Fore.YELLOW + "Verifying Archive..." + Fore.BLUE)
+            counts = account.verify_archive(args.verify_hashes, args.verify_all)
+            print(Fore.GREEN + "✔ Finished Verifying Archive.")
+            print(
+                Fore.BLUE + f"Verified: {Fore.YELLOW}{counts['verified']} checked, "
+                f"{counts['unchanged']} unchanged since the last verify"
+            )
+            print(
+                Fore.BLUE + f"Damaged: {Fore.YELLOW}{counts['missing']} missing, "
+                f"{counts['corrupt']} corrupt (queued to be downloaded again)"
+            )
+            print(
+                Fore.BLUE
+                + f"Untracked: {Fore.YELLOW}{counts['untracked']} files in the archive "
+                "that aren't in the database"
+            )
+        elif args.replay:
+            account.get_google_api_service()
+            startup_seconds = perf_counter() - STARTUP_TIMER
+            print(Fore.YELLOW + "Downloading Plan..." + Fore.BLUE)
+            account.replay_plan(SyncPlan.load(args.replay))
+            account.wait_for_downloads()
+            print(Fore.GREEN + "✔ Finished Downloading Plan.")
+        else:
+            account.get_google_api_service()
+            # Time from launch until the program is ready to make its first API request
+            startup_seconds = perf_counter() - STARTUP_TIMER
+            if args.plan is not None:
+                account.start_plan()
+
+            if args.favorites:
+                print(Fore.YELLOW + "Reading Favorites List From Server..." + Fore.BLUE)
+                account.download_favorites()
+                print(Fore.GREEN + "✔ Finished Reading Favorites.")
+
+            if args.albums:
+                print(Fore.YELLOW + "Reading Albums List From Server..." + Fore.BLUE)
+                account.download_all_albums()
+                print(Fore.GREEN + "✔ Finished Reading Albums.")
+
+            if args.shared:
+                print(
+                    Fore.YELLOW
+                    + "Reading Shared Albums List From Server..."
+                    + Fore.BLUE
+                )
+                account.download_all_shared_albums()
+                print(Fore.GREEN + "✔ Finished Reading Shared Albums.")
+
+            if download_everything:
+                print(Fore.YELLOW + "Reading Entire Library From Server..." + Fore.BLUE)
+                account.download_library(
+                    args.incremental, args.overlap_days, args.full_sync_days
+                )
+                print(Fore.GREEN + "✔ Finished Reading Library.")
+
+            if account.redownloads:
+                print(Fore.YELLOW + "Reading Media Queued By Verify..." + Fore.BLUE)
+                account.download_redownloads()
+                print(Fore.GREEN + "✔ Finished Reading Queued Media.")
+
+            if args.plan is not None:
+                print(Fore.YELLOW + "Estimating Download Size..." + Fore.BLUE)
+                account.estimate_plan()
+                print(Fore.RED + "\n=========")
+                print("SYNC PLAN")
+                print("=========")
+                for kind, listed, existing, planned, size in account.plan.get_summary():
+                    estimate = (
+                        "unknown size" if size is None else f"{size / 1024 ** 2:.1f} MB"
+                    )
+                    print(
+                        Fore.BLUE
+                        + f"{PLAN_KIND_NAMES[kind]}: {Fore.YELLOW}{planned} to download "
+                        f"({estimate}), {existing} already downloaded"
+                    )
+                if args.plan:
+                    account.plan.save(args.plan)
+                    print(Fore.GREEN + f"✔ Saved Plan To {args.plan}.")
+            else:
+                print(Fore.YELLOW + "Waiting For Downloads To Finish..." + Fore.BLUE)
+                account.wait_for_downloads()
+                print(Fore.GREEN + "✔ Finished Downloading Everything.")
 
     # Finish up and close program
     finally:
-        # Close db connection
-        account.con.close()
-
         # Print session stats
         seconds, downloads = account.get_session_stats()
+        requests_made, connections, reused = account.get_transport_stats()
+        (
+            download_retries,
+            download_throttles,
+            api_retries,
+            api_throttles,
+        ) = account.get_retry_stats()
+        deduplicated, deduplicated_bytes = account.get_dedupe_stats()
+        (
+            bytes_per_second,
+            api_per_second,
+            bandwidth_waited,
+            api_waited,
+        ) = account.get_rate_stats()
+
+        # Final metrics snapshot, taken before the transport drops its pool counters
+        if args.metrics_json or args.metrics_prom:
+            account.write_metrics(args.metrics_json, args.metrics_prom)
+
+        # Close db connection and http transport
+        account.close()
+
         print(Fore.RED + "\n=============")
         print("SESSION STATS")
         print("=============")
         print(Fore.BLUE + f"Seconds: {Fore.YELLOW}{seconds:.{2}f}s")
+        if startup_seconds is not None:
+            print(Fore.BLUE + f"Startup: {Fore.YELLOW}{startup_seconds:.{2}f}s")
         print(Fore.BLUE + f"Downloads: {Fore.YELLOW}{downloads} items")
+        print(
+            Fore.BLUE
+            + f"Connections: {Fore.YELLOW}{connections} opened, {reused} reused ({requests_made} requests)"
+        )
+        print(
+            Fore.BLUE
+            + f"Retries: {Fore.YELLOW}{download_retries} downloads, {api_retries} API requests"
+        )
+        print(
+            Fore.BLUE
+            + f"Throttled: {Fore.YELLOW}{download_throttles} downloads, {api_throttles} API requests"
+        )
+        print(
+            Fore.BLUE
+            + f"Rates: {Fore.YELLOW}{bytes_per_second / 1024 ** 2:.2f} MB/s downloads, "
+            f"{api_per_second:.2f} API requests/s"
+        )
+        if args.max_bandwidth or args.max_api_qps:
+            print(
+                Fore.BLUE
+                + f"Rate Limited: {Fore.YELLOW}{bandwidth_waited:.1f}s waiting on bandwidth, "
+                f"{api_waited:.1f}s waiting on API requests (summed over threads)"
+            )
+        print(
+            Fore.BLUE
+            + f"Deduplicated: {Fore.YELLOW}{deduplicated} items ({deduplicated_bytes / 1024 ** 2:.1f} MB saved)"
+        )
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# gparch and its engines are modules at the top of the repository, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gparch  # noqa: E402
+
+
+@pytest.fixture
+def make_account(tmp_path):
+    """
+    Returns a function making PhotosAccounts over an archive in tmp_path, closed after the test
+    - no Google credentials are needed until get_google_api_service is called
+    - failed downloads are retried without the usual backoff
+    """
+    accounts = []
+
+    def make(thread_count=2, **kwargs):
+        account = gparch.PhotosAccount(
+            None, str(tmp_path / "archive"), thread_count, False, **kwargs
+        )
+        account.download_retry.base_delay = 0.01
+        accounts.append(account)
+        return account
+
+    yield make
+    for account in accounts:
+        account.close()
@@ -0,0 +1,26 @@
+"""
+Batched database writes
+"""
+
+import sqlite3
+from time import sleep
+
+from gparch import DatabaseWriter
+
+
+def test_pending_writes_are_committed_without_new_writes(tmp_path):
+    path = str(tmp_path / "database.sqlite3")
+    con = sqlite3.connect(path, check_same_thread=False)
+    con.execute("CREATE TABLE media (uuid text)")
+    con.commit()
+    writer = DatabaseWriter(con, batch_size=500, commit_interval=0.2)
+    try:
+        writer.execute("INSERT INTO media (uuid) VALUES (?)", ("media",))
+        # Nothing else is written, like while every thread downloads a long video
+        sleep(0.6)
+        reader = sqlite3.connect(path)
+        assert reader.execute("SELECT COUNT(*) FROM media").fetchone()[0] == 1
+        reader.close()
+    finally:
+        writer.stop()
+        con.close()
@@ -0,0 +1,51 @@
+"""
+Linking identical files already in the archive with --dedupe
+"""
+
+import os
+
+import gparch
+
+
+def add_media(account, uuid, content):
+    path = account.lib_dir + "/" + uuid + ".jpg"
+    with open(path, "wb") as media_file:
+        media_file.write(content)
+    account.insert_media_item(uuid, path, None)
+    return path
+
+
+def test_dedupe_skips_unreadable_files(make_account, monkeypatch):
+    account = make_account()
+    first = add_media(account, "first", b"same content")
+    second = add_media(account, "second", b"same content")
+    unreadable = add_media(account, "unreadable", b"same content")
+    account.writer.commit()
+
+    hash_file = gparch.hash_file
+
+    def failing_hash_file(path, *args, **kwargs):
+        if path == unreadable:
+            raise PermissionError(13, "Permission denied", path)
+        return hash_file(path, *args, **kwargs)
+
+    monkeypatch.setattr(gparch, "hash_file", failing_hash_file)
+    account.dedupe_archive()
+
+    assert os.path.samefile(first, second)
+    assert not os.path.samefile(first, unreadable)
+    assert account.select_media_item("second")[3] is not None
+    assert account.select_media_item("unreadable")[3] is None
+
+
+def test_dedupe_only_counts_when_linking_is_off(make_account):
+    account = make_account(link_mode="off")
+    first = add_media(account, "first", b"same content")
+    second = add_media(account, "second", b"same content")
+    add_media(account, "other", b"other content")
+    account.writer.commit()
+
+    counts = account.dedupe_archive()
+
+    assert counts == {"duplicates": 1, "bytes": len(b"same content")}
+    assert not os.path.samefile(first, second)
@@ -0,0 +1,120 @@
+"""
+Date-windowed incremental library syncs against the fake Photos API of gparch_bench.py
+"""
+
+from datetime import datetime, timedelta, timezone
+from time import time
+
+import pytest
+
+from gparch import PhotosAccount
+from gparch_bench import FakeLibrary, FakePhotosServer, get_fake_service
+
+
+@pytest.fixture
+def server():
+    library = FakeLibrary(10, 0, 0, 0, 0, 0, 0, 1024, 1024)
+    with FakePhotosServer(library) as server:
+        yield server
+
+
+def add_item(library, uuid, days_ago, archived=False):
+    created = datetime.now(timezone.utc) - timedelta(days=days_ago)
+    item = {
+        "id": uuid,
+        "filename": uuid + ".JPG",
+        "mimeType": "image/jpeg",
+        "mediaMetadata": {
+            "creationTime": f"{created:%Y-%m-%dT%H:%M:%SZ}",
+            "width": "4032",
+            "height": "3024",
+        },
+    }
+    library.items.append(item)
+    library.items_by_id[uuid] = item
+    library.sizes[uuid] = 1024
+    if archived:
+        library.archived.add(uuid)
+
+
+def sync(directory, server, **kwargs):
+    """
+    Runs an incremental library sync in a new session and returns its phase
+    """
+    account = PhotosAccount(None, directory, 2, False)
+    account.service = get_fake_service(server.root_url)
+    try:
+        account.download_library(incremental=True, **kwargs)
+        account.wait_for_downloads()
+        return account.scheduler.phases[-1]
+    finally:
+        account.close()
+
+
+def get_sync_state(directory, name):
+    account = PhotosAccount(None, directory, 1, False)
+    try:
+        return account.select_sync_state(name)
+    finally:
+        account.close()
+
+
+def test_first_incremental_sync_lists_everything(tmp_path, server):
+    directory = str(tmp_path)
+    started_at = time()
+    phase = sync(directory, server)
+
+    assert phase.desc == "Downloading Library"
+    assert phase.downloaded == 10
+    assert get_sync_state(directory, "library_synced_at") >= started_at
+    assert get_sync_state(directory, "library_full_synced_at") >= started_at
+
+
+def test_incremental_sync_lists_new_archived_media(tmp_path, server):
+    directory = str(tmp_path)
+    sync(directory, server)
+    add_item(server.library, "NEW_ARCHIVED", 0, archived=True)
+
+    phase = sync(directory, server)
+
+    assert phase.desc.startswith("Downloading Library (since ")
+    assert phase.submitted == 1
+    assert phase.downloaded == 1
+
+
+def test_overlap_window_relists_recent_media(tmp_path, server):
+    directory = str(tmp_path)
+    sync(directory, server)
+    # Created 3 days before the last sync but uploaded after it
+    add_item(server.library, "LATE_UPLOAD", 3)
+
+    phase = sync(directory, server, overlap_days=1)
+    assert phase.submitted == 0
+    phase = sync(directory, server, overlap_days=7)
+    assert phase.downloaded == 1
+
+
+def test_failed_sync_keeps_watermark(tmp_path, server):
+    directory = str(tmp_path)
+    sync(directory, server)
+    synced_at = get_sync_state(directory, "library_synced_at")
+    add_item(server.library, "UNAVAILABLE", 0)
+    del server.library.sizes["UNAVAILABLE"]  # the media server answers 404
+
+    phase = sync(directory, server)
+
+    assert phase.failed == 1
+    assert get_sync_state(directory, "library_synced_at") == synced_at
+
+
+def test_full_sync_when_due(tmp_path, server):
+    directory = str(tmp_path)
+    sync(directory, server)
+    account = PhotosAccount(None, directory, 1, False)
+    account.insert_sync_state("library_full_synced_at", time() - 10 * 86400)
+    account.close()
+
+    phase = sync(directory, server, full_sync_days=7)
+
+    assert phase.desc == "Downloading Library"
+    assert phase.submitted == 10
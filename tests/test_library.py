@@ -0,0 +1,58 @@
+"""
+Library layouts and reindexing of the files already in the archive
+"""
+
+import os
+
+from gparch import get_library_shard
+from gparch_bench import FakeLibrary, FakePhotosServer, get_fake_service
+
+
+def add_media(account, uuid):
+    path = account.lib_dir + "/" + uuid + ".jpg"
+    with open(path, "wb") as media_file:
+        media_file.write(uuid.encode())
+    account.insert_media_item(uuid, path, None)
+    return path
+
+
+def test_migration_resumes_after_interruption(make_account):
+    account = make_account()
+    uuids = ["moved", "waiting", "missing"]
+    paths = [add_media(account, uuid) for uuid in uuids]
+    account.writer.commit()
+    # Killed after "moved" was moved but before its path update was committed
+    shard = account.lib_dir + "/" + get_library_shard("hash", "moved", None)
+    os.makedirs(shard)
+    os.replace(paths[0], shard + "/moved.jpg")
+    os.remove(paths[2])
+
+    moved, missing = account.migrate_library_layout("hash")
+
+    assert (moved, missing) == (2, 1)
+    for uuid in ("moved", "waiting"):
+        path = account.select_media_item(uuid)[1]
+        assert os.path.dirname(path) == account.get_library_dir(uuid, None)
+        with open(path, "rb") as media_file:
+            assert media_file.read() == uuid.encode()
+
+
+def test_reindex_matches_filenames_ending_in_a_number(make_account):
+    library = FakeLibrary(4, 0, 0, 0, 0, 0, 0, 1024, 1024)
+    names = ["Scan (1).JPG", "Scan (2).JPG", "Scan.JPG", "Scan.JPG"]
+    # The second Scan.JPG was saved with a (#) after the names ending in a number
+    saved = ["Scan (1).JPG", "Scan (2).JPG", "Scan.JPG", "Scan (3).JPG"]
+    with FakePhotosServer(library) as server:
+        account = make_account()
+        account.service = get_fake_service(server.root_url)
+        for item, name, saved_name in zip(library.items, names, saved):
+            item["filename"] = name
+            with open(account.lib_dir + "/" + saved_name, "wb") as media_file:
+                media_file.write(bytes(library.sizes[item["id"]]))
+
+        counts = account.reindex_archive()
+
+    assert (counts["matched"], counts["unmatched"]) == (4, 0)
+    for item, saved_name in zip(library.items, saved):
+        path = account.select_media_item(item["id"])[1]
+        assert os.path.basename(path) == saved_name
@@ -0,0 +1,27 @@
+"""
+Memory held by queued downloads, measured like gparch_bench.py memory
+"""
+
+import json
+
+from gparch import iter_entries
+from gparch_bench import keep_entries, make_api_page, measure_listing
+
+COUNT = 10000
+# About 800 bytes are measured, most of it the id and baseUrl strings (about 460
+# characters), keeping the API dict or more strings per entry goes over
+MAX_ENTRY_BYTES = 1024
+
+
+def test_media_entries_stay_compact():
+    entry_bytes = measure_listing(COUNT, lambda items: keep_entries(items, "Library"))
+    dict_bytes = measure_listing(COUNT, list)
+
+    assert entry_bytes / COUNT < MAX_ENTRY_BYTES
+    assert entry_bytes < dict_bytes / 2
+
+
+def test_media_entries_have_no_dict():
+    items = json.loads(make_api_page(0, 1))["mediaItems"]
+    entry = next(iter_entries(items))
+    assert not hasattr(entry, "__dict__")
@@ -0,0 +1,25 @@
+"""
+--plan dry runs against the fake Photos API of gparch_bench.py
+"""
+
+from gparch_bench import FakeLibrary, FakePhotosServer, get_fake_service
+
+
+def test_plan_leaves_redownload_queue_alone(make_account):
+    library = FakeLibrary(2, 0, 0, 0, 0, 0, 0, 1024, 1024)
+    with FakePhotosServer(library) as server:
+        account = make_account()
+        account.service = get_fake_service(server.root_url)
+        listed = library.items[0]["id"]
+        for uuid in (listed, "DELETED_FROM_GOOGLE_PHOTOS"):
+            account.insert_media_item(uuid, account.lib_dir + f"/{uuid}.JPG", None)
+            account.queue_redownload(uuid, "missing")
+
+        plan = account.start_plan()
+        account.download_redownloads()
+
+    assert [entry.uuid for entry in plan.phases[0]["entries"]] == [listed]
+    with account.writer.lock:
+        queued = account.cur.execute("SELECT uuid FROM redownloads").fetchall()
+    assert sorted(queued) == sorted([(listed,), ("DELETED_FROM_GOOGLE_PHOTOS",)])
+    assert "DELETED_FROM_GOOGLE_PHOTOS" in account.redownloads
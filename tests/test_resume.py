@@ -0,0 +1,155 @@
+"""
+Resuming interrupted downloads against a local media server that supports Range requests
+"""
+
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+
+import pytest
+
+import gparch
+import gparch_async
+from gparch import ENGINES, IncompleteDownloadError, MediaEntry, get_part_path
+
+CONTENT = bytes(range(256)) * 256  # 64 KiB of media
+CHUNK_SIZE = 4096
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves CONTENT at every path
+    - server.honour_range: answer Range requests with 206 (otherwise the full content, 200)
+    - server.cut: bytes sent before the connection stalls and drops, for the next response only
+    - server.requests: the Range header of every request, None when there was none
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        byte_range = self.headers.get("Range")
+        server.requests.append(byte_range)
+
+        start = 0
+        if byte_range and server.honour_range:
+            start = int(byte_range[len("bytes=") :].split("-")[0])
+        body = CONTENT[start:]
+        if start:
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if server.cut is None:
+            self.wfile.write(body)
+            return
+        body, server.cut = body[: server.cut], None
+        self.wfile.write(body)
+        self.wfile.flush()
+        # Clients may drop what they buffered if the connection closes at the same time
+        sleep(0.2)
+        self.close_connection = True
+
+
+@pytest.fixture
+def media_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.honour_range = True
+    server.cut = None
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=ENGINES)
+def account(request, make_account, monkeypatch):
+    # Small enough that CONTENT is tracked as a resumable partial download
+    monkeypatch.setattr(gparch, "RESUME_MIN_SIZE", 1024)
+    monkeypatch.setattr(gparch, "DOWNLOAD_CHUNK_SIZE", CHUNK_SIZE)
+    monkeypatch.setattr(gparch_async, "DOWNLOAD_CHUNK_SIZE", CHUNK_SIZE)
+    return make_account(engine=request.param)
+
+
+def make_entry(account, media_server, uuid="media"):
+    return MediaEntry(
+        uuid,
+        f"http://127.0.0.1:{media_server.server_port}/{uuid}",
+        False,
+        "photo.jpg",
+        listed_at=time(),
+        directory=account.lib_dir,
+    )
+
+
+def download(account, entry):
+    account.download([entry], "Downloading Test", "library")
+    account.wait_for_downloads()
+    with open(entry.path, "rb") as media_file:
+        return media_file.read()
+
+
+def start_partial(account, entry, size, expected_size):
+    # What an earlier run leaves behind when it is killed partway through a download
+    part_path = get_part_path(entry.path, entry.uuid)
+    with open(part_path, "wb") as part_file:
+        part_file.write(CONTENT[:size])
+    account.insert_partial(entry.uuid, part_path, expected_size)
+    return part_path
+
+
+def test_resumes_interrupted_download(account, media_server):
+    media_server.cut = 5 * CHUNK_SIZE
+    entry = make_entry(account, media_server)
+
+    assert download(account, entry) == CONTENT
+    assert media_server.requests[0] is None
+    first, last = media_server.requests[1][len("bytes=") :].split("-")
+    assert 0 < int(first) <= 5 * CHUNK_SIZE
+    assert last == ""
+    assert account.metrics.get("resumed_total") == 1
+    assert entry.uuid not in account.partials
+    assert account.select_media_item(entry.uuid) is not None
+
+
+def test_restarts_when_server_ignores_range(account, media_server):
+    media_server.honour_range = False
+    entry = make_entry(account, media_server)
+    start_partial(account, entry, 20000, len(CONTENT))
+
+    assert download(account, entry) == CONTENT
+    assert media_server.requests == ["bytes=20000-"]
+    assert not account.metrics.get("resumed_total")
+
+
+def test_restarts_on_mismatched_content_range(account, media_server):
+    entry = make_entry(account, media_server)
+    # The recorded size is off, so the server's 206 doesn't continue this partial download
+    start_partial(account, entry, 20000, len(CONTENT) + 5)
+
+    assert download(account, entry) == CONTENT
+    assert media_server.requests == ["bytes=20000-", None]
+    assert not account.metrics.get("resumed_total")
+    assert not os.path.exists(get_part_path(entry.path, entry.uuid))
+
+
+def test_rejects_part_file_of_wrong_size(account, tmp_path):
+    part_path = str(tmp_path / "media.part")
+    with open(part_path, "wb") as part_file:
+        part_file.write(CONTENT[:100])
+
+    account.check_part_size(part_path, 100)
+    account.check_part_size(part_path, None)
+    with pytest.raises(IncompleteDownloadError):
+        account.check_part_size(part_path, len(CONTENT))
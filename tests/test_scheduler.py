@@ -0,0 +1,65 @@
+"""
+Image and video lanes of the thread download scheduler
+"""
+
+import threading
+from time import perf_counter, sleep
+
+from gparch import DownloadLanes, DownloadScheduler, MediaEntry, Metrics
+
+VIDEO_SECONDS = 1
+
+
+def test_images_start_while_video_lane_is_full():
+    started = {}
+    lock = threading.Lock()
+
+    def worker(entry):
+        with lock:
+            started[entry.uuid] = perf_counter()
+        sleep(VIDEO_SECONDS if entry.is_video else 0.01)
+        return False
+
+    lanes = DownloadLanes(8, 8, 4)
+    scheduler = DownloadScheduler(worker, 8, lambda *result: None, Metrics(), lanes)
+    start = perf_counter()
+    try:
+        phase = scheduler.start_phase("Downloading Test", "library")
+        # Videos listed first take 4 threads and make the rest wait for the images
+        for i in range(12):
+            scheduler.submit(phase, MediaEntry(f"video{i}", "", True, f"{i}.mp4"))
+        for i in range(20):
+            scheduler.submit(phase, MediaEntry(f"image{i}", "", False, f"{i}.jpg"))
+        phase.finish_listing()
+        scheduler.join()
+    finally:
+        scheduler.shutdown()
+
+    images = [started[f"image{i}"] - start for i in range(20)]
+    assert max(images) < VIDEO_SECONDS / 2
+    assert lanes.completed == {"image": 20, "video": 12}
+
+
+def test_smallest_starts_images_before_smaller_videos():
+    lanes = DownloadLanes(1, 1, 1, priority="smallest")
+    entries = [
+        # A 1080p video has fewer pixels than either photo
+        MediaEntry("video", "", True, "v.mp4", pixels=1920 * 1080),
+        MediaEntry("large", "", False, "l.jpg", pixels=4032 * 3024),
+        MediaEntry("small", "", False, "s.jpg", pixels=3000 * 2000),
+        MediaEntry("unknown", "", False, "u.jpg"),
+    ]
+    for entry in entries:
+        lanes.reserve(entry)
+        lanes.push(None, entry)
+
+    started = []
+    while True:
+        popped = lanes.pop()
+        if popped is None:
+            break
+        lane, _, entry = popped
+        started.append(entry.uuid)
+        lanes.release(lane)
+
+    assert started == ["small", "large", "unknown", "video"]